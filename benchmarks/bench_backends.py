@@ -0,0 +1,367 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+"""
+Time the operations of the backends, through the field files and the
+storage of a model, on synthetic repositories of different numbers of
+documents, depths of history and sizes of documents, and report their
+throughput, latency percentiles and the peak memory, as JSON.
+
+Usage: python benchmarks/bench_backends.py [--backends git,bare,db]
+           [--documents 1,1000] [--depths 1,10] [--sizes 1K,100K]
+           [--samples 100] [--batch 10000] [--seed 0] [--setting NAME=VALUE]
+           [--output results.json] [--baseline old-results.json]
+
+Each combination of backend, documents, depth and size runs in a fresh
+process, with a fresh repository and database. The repository is filled in
+bulk (a commit per --batch documents and revision), and then each operation
+is timed --samples times, on documents picked at random with --seed; the
+contents are a function of the document and the revision, so two runs with
+the same arguments do the same work. With --baseline, the p50 and p99 of
+each operation are compared with those of a previous run.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import datetime
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+
+BACKENDS = {
+    'git': {'VFF_BACKEND': 'vff.git_backend.GitBackend'},
+    'bare': {'VFF_BACKEND': 'vff.git_backend.GitBackend',
+             'VFF_BARE_REPO': True},
+    'indexed': {'VFF_BACKEND': 'vff.git_backend.GitBackend',
+                'VFF_REVISION_INDEX': True},
+    'sharded': {'VFF_BACKEND': 'vff.sharded_backend.ShardedGitBackend'},
+    'db': {'VFF_BACKEND': 'vff.db_backend.DBBackend'},
+}
+
+OPERATIONS = ('get_revision', 'get_latest', 'list_revisions',
+              'count_revisions', 'get_diff', 'save', 'delete')
+
+PAGE = 20
+
+
+def parse_size(size):
+    if size[-1].upper() in UNITS:
+        return int(size[:-1]) * UNITS[size[-1].upper()]
+    return int(size)
+
+
+def parse_setting(setting):
+    import ast
+    name, value = setting.split('=', 1)
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+def content(pk, revision, size):
+    """
+    The content of the given revision of the document with the given pk,
+    about size bytes of XML lines, of which each revision changes one.
+    """
+    line = b'<entity doc="%d" line="%%d" revision="%%d">%s</entity>\n'
+    line = line % (pk, b'x' * 32)
+    lines = max(1, size // len(line % (0, 0)))
+    changed = (pk + revision) % lines
+    return b''.join(line % (i, i == changed and revision or 0)
+                    for i in range(lines))
+
+
+def percentile(latencies, p):
+    # nearest rank, on sorted latencies
+    return latencies[max(0, int(math.ceil(p / 100.0 * len(latencies))) - 1)]
+
+
+def summarize(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {'count': len(latencies),
+            'ops_per_second': total and len(latencies) / total or None,
+            'mean_ms': total / len(latencies) * 1000,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000}
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes there, kilobytes on linux
+        peak //= 1024
+    return peak
+
+
+def setup(root, backend, extra):
+    from django.conf import settings
+    options = dict(BACKENDS[backend])
+    options.update(extra)
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': os.path.join(root, 'db.sqlite')}},
+        INSTALLED_APPS=['vff', 'benchmarks'],
+        VFF_REPO_ROOT=os.path.join(root, 'repo'),
+        MEDIA_ROOT=root,
+        VFF_CACHE_SIZE=0,
+        **options)
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def populate(documents, depth, size, batch):
+    """
+    Create the instances, and depth revisions of each of their documents,
+    in bulk. Return the number of seconds it took to write the revisions.
+    """
+    from django.core.files.base import ContentFile
+    from benchmarks.models import Document
+    storage = Document._meta.get_field('content').storage
+    for start in range(1, documents + 1, batch):
+        Document.objects.bulk_create(
+            Document(pk=pk, name='doc%d' % pk)
+            for pk in range(start, min(start + batch, documents + 1)))
+    elapsed = 0
+    for revision in range(1, depth + 1):
+        for start in range(1, documents + 1, batch):
+            instances = Document.objects.filter(pk__gte=start,
+                                                pk__lt=start + batch)
+            revisions = [(instance,
+                          ContentFile(content(instance.pk, revision, size)))
+                         for instance in instances]
+            began = time.time()
+            storage.bulk_save(revisions, 'bench', 'revision %d' % revision,
+                              save=False)
+            elapsed += time.time() - began
+    return elapsed
+
+
+def time_operations(documents, depth, size, samples, seed):
+    """
+    Time each of the OPERATIONS samples times, on documents picked at
+    random, and return the latencies of each, in seconds.
+    """
+    from django.core.files.base import ContentFile
+    from benchmarks.models import Document
+    rnd = random.Random(seed)
+    latencies = dict((operation, []) for operation in OPERATIONS)
+    saved = {}
+    deleted = set()
+
+    def timed(operation, func, *args, **kwargs):
+        began = time.time()
+        func(*args, **kwargs)
+        latencies[operation].append(time.time() - began)
+
+    for i in range(samples):
+        pk = rnd.randint(1, documents)
+        if pk in deleted:
+            continue
+        # fetched anew each time, so nothing is remembered from the last
+        versionids = [r['versionid'] for r in
+                      Document.objects.get(pk=pk).content.list_revisions()]
+        fieldfile = Document.objects.get(pk=pk).content
+        timed('get_revision', fieldfile.get_revision, rnd.choice(versionids))
+        timed('get_latest', fieldfile.get_revision)
+        timed('list_revisions', fieldfile.list_revisions, count=PAGE)
+        timed('count_revisions', fieldfile.count_revisions)
+        if len(versionids) > 1:
+            old, new = sorted(rnd.sample(range(len(versionids)), 2))
+            timed('get_diff', fieldfile.get_diff, versionids[new],
+                  versionids[old])
+        instance = Document.objects.get(pk=pk)
+        revision = saved[pk] = saved.get(pk, depth) + 1
+        new_content = ContentFile(content(pk, revision, size))
+
+        def save():
+            instance.content.save(instance.name, new_content, 'bench',
+                                  'revision %d' % revision)
+            instance.save()
+        timed('save', save)
+        if i % 10 == 9 and documents > 1:
+            # a tenth as many deletes, as they shrink the repository
+            instance = Document.objects.get(pk=pk)
+
+            def delete():
+                instance.content.delete('bench', 'removed')
+                instance.delete()
+            timed('delete', delete)
+            deleted.add(pk)
+    return latencies
+
+
+def measure(backend, documents, depth, size, args, results):
+    root = tempfile.mkdtemp()
+    try:
+        setup(root, backend, dict(args.setting))
+        writes = populate(documents, depth, size, args.batch)
+        populated_rss = peak_rss_kb()
+        latencies = time_operations(documents, depth, size, args.samples,
+                                    args.seed)
+        results.put({
+            'backend': backend,
+            'documents': documents,
+            'depth': depth,
+            'size': size,
+            'populate': {
+                'seconds': writes,
+                'revisions': documents * depth,
+                'revisions_per_second': writes and documents * depth / writes,
+                'peak_rss_kb': populated_rss,
+            },
+            'operations': dict((operation, summarize(latencies[operation]))
+                               for operation in OPERATIONS),
+            'peak_rss_kb': peak_rss_kb(),
+        })
+    except Exception as e:
+        results.put({'backend': backend, 'documents': documents,
+                     'depth': depth, 'size': size,
+                     'error': '%s: %s' % (e.__class__.__name__, e)})
+        raise
+    finally:
+        shutil.rmtree(root)
+
+
+def environment(args):
+    import django
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution('django-vff').version
+    except Exception:
+        version = None
+    try:
+        git_version = subprocess.check_output(['git', '--version']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_version = None
+    return {'django_vff': version,
+            'django': django.get_version(),
+            'git': git_version,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.utcnow().isoformat(),
+            'arguments': vars(args)}
+
+
+def key(result):
+    return (result['backend'], result['documents'], result['depth'],
+            result['size'])
+
+
+def compare(baseline, results, out):
+    """
+    Write to out the ratios of the p50 and p99 latencies of each operation
+    in results to those in baseline; above 1 is slower than the baseline.
+    """
+    old = dict((key(result), result) for result in baseline['results']
+               if 'operations' in result)
+    out.write('%-8s %9s %6s %9s %16s %8s %8s\n' % (
+        'backend', 'documents', 'depth', 'size', 'operation', 'p50', 'p99'))
+    for result in results:
+        if 'operations' not in result or key(result) not in old:
+            continue
+        for operation in OPERATIONS:
+            now = result['operations'][operation]
+            then = old[key(result)]['operations'].get(operation)
+            if not now or not then:
+                continue
+            out.write('%-8s %9d %6d %9d %16s %8.2f %8.2f\n' % (
+                key(result) + (operation,
+                               now['p50_ms'] / (then['p50_ms'] or 1e-9),
+                               now['p99_ms'] / (then['p99_ms'] or 1e-9))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--backends', default='git,bare,db',
+                        help='Some of %s.' % ', '.join(sorted(BACKENDS)))
+    parser.add_argument('--documents', default='1,1000')
+    parser.add_argument('--depths', default='1,10')
+    parser.add_argument('--sizes', default='1K,100K')
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--batch', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--setting', action='append', default=[],
+                        type=parse_setting,
+                        help='An extra django setting, e.g.'
+                             ' VFF_GROUP_COMMIT=True; can be repeated.')
+    parser.add_argument('--output', default='-',
+                        help='File to write the JSON to, - for stdout.')
+    parser.add_argument('--baseline',
+                        help='JSON of a previous run to compare with.')
+    args = parser.parse_args()
+    backends = args.backends.split(',')
+    for backend in backends:
+        if backend not in BACKENDS:
+            parser.error('Unknown backend %r.' % backend)
+    report = {'environment': environment(args), 'results': []}
+    for backend in backends:
+        for documents in [int(d) for d in args.documents.split(',')]:
+            for depth in [int(d) for d in args.depths.split(',')]:
+                for size in [parse_size(s) for s in args.sizes.split(',')]:
+                    sys.stderr.write('%s: %d documents, %d revisions,'
+                                     ' %d bytes\n' % (backend, documents,
+                                                      depth, size))
+                    results = multiprocessing.Queue()
+                    proc = multiprocessing.Process(
+                        target=measure,
+                        args=(backend, documents, depth, size, args,
+                              results))
+                    proc.start()
+                    report['results'].append(results.get())
+                    proc.join()
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), report['results'], sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
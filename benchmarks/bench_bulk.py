@@ -0,0 +1,116 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+"""
+Compare the time it takes to add a revision to each of N documents one by
+one, with GitBackend.add_revision (one commit each), with that of adding
+them all at once with GitBackend.bulk_add_revisions (a single commit), for
+different values of N.
+
+Usage: python benchmarks/bench_bulk.py [--counts 100,1000,10000] [--bare]
+                                       [--max-single 2000]
+
+Each measurement runs in a fresh process and repository. The one by one
+path is skipped for more than --max-single documents, as it gets slower
+with every commit.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Document(object):
+    """
+    Stands for a model instance; get_filename only needs its class and pk.
+    """
+
+    def __init__(self, pk):
+        self.pk = pk
+
+
+def setup(root, bare):
+    from django.conf import settings
+    settings.configure(VFF_REPO_ROOT=os.path.join(root, 'repo'),
+                       MEDIA_ROOT=root,
+                       VFF_BARE_REPO=bare,
+                       VFF_CACHE_SIZE=0)
+    from vff.git_backend import GitBackend
+    return GitBackend('content')
+
+
+def measure(count, bulk, bare, results):
+    from django.core.files.base import ContentFile
+    root = tempfile.mkdtemp()
+    try:
+        backend = setup(root, bare)
+        revisions = [(Document(i),
+                      ContentFile(b'<entity n="%d">some xml content</entity>\n'
+                                  % i))
+                     for i in range(count)]
+        start = time.time()
+        if bulk:
+            backend.bulk_add_revisions(revisions, 'bench', 'bench')
+        else:
+            for instance, content in revisions:
+                backend.add_revision(content, instance, 'bench', 'bench')
+        results.put(time.time() - start)
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--counts', default='100,1000,10000')
+    parser.add_argument('--bare', action='store_true')
+    parser.add_argument('--max-single', type=int, default=2000)
+    args = parser.parse_args()
+    print('%10s %8s %12s %12s' % ('documents', 'path', 'seconds', 'docs/s'))
+    for count in [int(c) for c in args.counts.split(',')]:
+        for bulk in (False, True):
+            if not bulk and count > args.max_single:
+                print('%10d %8s %12s %12s' % (count, 'single', '-', '-'))
+                continue
+            results = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=measure,
+                                           args=(count, bulk, args.bare,
+                                                 results))
+            proc.start()
+            seconds = results.get()
+            proc.join()
+            print('%10d %8s %12.3f %12.1f' % (
+                count, bulk and 'bulk' or 'single', seconds, count / seconds))
+
+
+if __name__ == '__main__':
+    main()
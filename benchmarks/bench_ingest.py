@@ -0,0 +1,145 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+"""
+Compare the peak memory and the throughput of GitBackend.add_revision with
+those of the ingestion path used up to django-vff 0.2 (read the whole
+upload into memory, write it to the working tree, and let index.add hash
+it again), for inputs of different sizes.
+
+Usage: python benchmarks/bench_ingest.py [--sizes 1K,1M,100M,500M] [--repeat 3]
+
+Each measurement runs in a fresh process, so that peak RSS is not
+polluted by the previous ones.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+
+
+def parse_size(size):
+    if size[-1].upper() in UNITS:
+        return int(size[:-1]) * UNITS[size[-1].upper()]
+    return int(size)
+
+
+class Document(object):
+    """
+    Stands for a model instance; get_filename only needs its class and pk.
+    """
+
+    def __init__(self, pk):
+        self.pk = pk
+
+
+def setup(root):
+    from django.conf import settings
+    settings.configure(VFF_REPO_ROOT=os.path.join(root, 'repo'),
+                       MEDIA_ROOT=root,
+                       VFF_CACHE_SIZE=0)
+    from vff.git_backend import GitBackend
+    return GitBackend('content')
+
+
+def legacy_add_revision(backend, content, instance, commit_msg, username):
+    from vff.git_backend import get_identity
+    fname = backend.get_filename(instance)
+    with open(os.path.join(backend.location, fname), 'w') as f:
+        content.seek(0)
+        f.write(content.read())
+    actor = get_identity(username)
+    backend.repo.index.add([fname])
+    backend.repo.index.commit(commit_msg, author=actor, committer=actor)
+
+
+def measure(path, legacy, repeat, results):
+    from django.core.files import File
+    root = tempfile.mkdtemp()
+    try:
+        backend = setup(root)
+        add_revision = legacy and legacy_add_revision or (
+            lambda b, *args: b.add_revision(*args))
+        elapsed = 0
+        for i in range(repeat):
+            with open(path, 'rb') as f:
+                content = File(f)
+                start = time.time()
+                add_revision(backend, content, Document(i), 'bench', 'bench')
+                elapsed += time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results.put((elapsed / repeat, peak))
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1K,100K,1M,10M,100M,500M')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    print('%10s %8s %12s %12s %12s' % ('size', 'path', 'seconds',
+                                       'MB/s', 'peak RSS MB'))
+    for size in args.sizes.split(','):
+        nbytes = parse_size(size)
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            line = b'<entity>some xml content</entity>\n'
+            written = 0
+            while written < nbytes:
+                chunk = line * 1024
+                chunk = chunk[:nbytes - written]
+                f.write(chunk)
+                written += len(chunk)
+        try:
+            for legacy in (True, False):
+                results = multiprocessing.Queue()
+                proc = multiprocessing.Process(
+                    target=measure,
+                    args=(path, legacy, args.repeat, results))
+                proc.start()
+                seconds, peak = results.get()
+                proc.join()
+                # ru_maxrss is in kilobytes on linux
+                print('%10s %8s %12.4f %12.1f %12.1f' % (
+                    size, legacy and 'legacy' or 'chunked', seconds,
+                    nbytes / seconds / 2 ** 20, peak / 1024.0))
+        finally:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+"""
+Stress GitBackend commits from many threads of one process at once, and
+check that every commit is attributed to the user that made it, that no
+write is lost or committed twice, and that os.environ is left untouched.
+
+Usage: python benchmarks/stress_commit.py [--threads 16] [--commits 25]
+           [--bare] [--setting NAME=VALUE]
+
+Each thread commits under its own username, alternately to a document of
+its own and to one shared by all the threads, with a message naming the
+thread and the write. Exits with status 1, listing the problems, if any
+check fails.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Document(object):
+    """
+    Stands for a model instance; get_filename only needs its class and pk.
+    """
+
+    def __init__(self, pk):
+        self.pk = pk
+
+
+def parse_setting(setting):
+    import ast
+    name, value = setting.split('=', 1)
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+def identity(thread):
+    """
+    The username that thread commits as, in the three forms that the
+    backend parses, and the author name and email it should get.
+    """
+    name = 'user%d' % thread
+    email = '%s@example.com' % name
+    if thread % 3 == 0:
+        return 'User %d <%s>' % (thread, email), 'User %d' % thread, email
+    elif thread % 3 == 1:
+        return email, name, email
+    return name, name, name
+
+
+def setup(root, bare, extra):
+    from django.conf import settings
+    settings.configure(VFF_REPO_ROOT=os.path.join(root, 'repo'),
+                       MEDIA_ROOT=root,
+                       VFF_BARE_REPO=bare,
+                       VFF_CACHE_SIZE=0,
+                       **extra)
+    from vff.git_backend import GitBackend
+    return GitBackend('content')
+
+
+def target(thread, write):
+    # odd writes go to the shared document, 0
+    return write % 2 and 0 or thread + 1
+
+
+def commit(backend, thread, commits, errors):
+    from django.core.files.base import ContentFile
+    username = identity(thread)[0]
+    try:
+        for write in range(commits):
+            pk = target(thread, write)
+            content = ContentFile(b'<entity thread="%d" write="%d"/>\n'
+                                  % (thread, write))
+            result = backend.add_revision(content, Document(pk),
+                                          'thread %d write %d'
+                                          % (thread, write), username)
+            if hasattr(result, 'result'):
+                # a future, with group commits
+                result.result()
+    except Exception as e:
+        errors.append('thread %d: %s: %s' % (thread, e.__class__.__name__,
+                                             e))
+
+
+def watch(environ, stop, errors):
+    """
+    Compare os.environ with its copy environ until stop is set.
+    """
+    while not stop.is_set():
+        current = dict(os.environ)
+        if current != environ:
+            changed = sorted(set(current.items()) ^ set(environ.items()))
+            errors.append('os.environ changed: %r' % (changed,))
+            return
+        time.sleep(0.001)
+
+
+def check(backend, threads, commits, group):
+    """
+    Return the problems with the history of the documents: writes missing
+    or listed twice, and writes attributed to another user than the one
+    that made them. If group is true, writes are committed by a group
+    commit or the write behind spool, so only their author is checked.
+    """
+    problems = []
+    expected = {}
+    for thread in range(threads):
+        for write in range(commits):
+            expected.setdefault(target(thread, write), set()).add(
+                (thread, write))
+    for pk, writes in sorted(expected.items()):
+        listed = []
+        for revision in backend.list_revisions(Document(pk)):
+            words = revision['message'].split()
+            if len(words) != 4 or words[0] != 'thread':
+                # the README of a new repository
+                continue
+            thread, write = int(words[1]), int(words[3])
+            listed.append((thread, write))
+            username, name, email = identity(thread)
+            if revision['author'] != name:
+                problems.append('document %d, %s: author %r, not %r' % (
+                    pk, revision['message'], revision['author'], name))
+            commit = backend.repo.commit(revision['versionid'])
+            if not group and (commit.author.email != email or
+                              commit.committer.email != email):
+                problems.append('document %d, %s: committed as %s / %s,'
+                                ' not %s' % (pk, revision['message'],
+                                             commit.author.email,
+                                             commit.committer.email, email))
+        if len(listed) != len(set(listed)):
+            problems.append('document %d: writes listed twice' % pk)
+        if set(listed) != writes:
+            problems.append('document %d: %d writes missing, %d unexpected'
+                            % (pk, len(writes - set(listed)),
+                               len(set(listed) - writes)))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--commits', type=int, default=25,
+                        help='Writes made by each thread.')
+    parser.add_argument('--bare', action='store_true')
+    parser.add_argument('--setting', action='append', default=[],
+                        type=parse_setting,
+                        help='An extra django setting, e.g.'
+                             ' VFF_GROUP_COMMIT=True; can be repeated.')
+    args = parser.parse_args()
+    root = tempfile.mkdtemp()
+    try:
+        extra = dict(args.setting)
+        backend = setup(root, args.bare, extra)
+        # have the repository created before the threads start
+        backend.list_revisions(Document(0))
+        environ = dict(os.environ)
+        errors = []
+        stop = threading.Event()
+        watcher = threading.Thread(target=watch, args=(environ, stop, errors))
+        watcher.start()
+        workers = [threading.Thread(target=commit,
+                                    args=(backend, thread, args.commits,
+                                          errors))
+                   for thread in range(args.threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.time() - start
+        stop.set()
+        watcher.join()
+        if dict(os.environ) != environ:
+            errors.append('os.environ changed')
+        errors.extend(check(backend, args.threads, args.commits,
+                            extra.get('VFF_GROUP_COMMIT', False) or
+                            extra.get('VFF_WRITE_BEHIND', False)))
+        writes = args.threads * args.commits
+        print('%d threads, %d writes in %.3f seconds, %.1f writes/s' % (
+            args.threads, writes, seconds, writes / seconds))
+        for error in errors:
+            print(error)
+        print(errors and 'FAILED' or 'OK')
+        return errors and 1 or 0
+    finally:
+        # stop the write behind spool before its directory goes away
+        from vff.git_repo import release_repos
+        release_repos()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -51,10 +51,13 @@ setup(name='django-vff',
       author_email='eperez@yaco.es',
       url='https://github.com/Yaco-Sistemas/django-vff',
       license='BSD',
-      packages=find_packages(),
+      packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
       include_package_data=True,
       zip_safe=False,
       install_requires=[
           'GitPython==0.3.6',
       ],
+      extras_require={
+          'async': ['futures'],
+      },
 )
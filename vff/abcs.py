@@ -26,10 +26,79 @@
 # of the authors and should not be interpreted as representing official policies,
 # either expressed or implied, of Terena.
 
+from io import BytesIO
 from abc import ABCMeta, abstractmethod
 
+from vff.executor import get_executor
 
-class VFFBackend(object):
+
+class RevisionPage(list):
+    """
+    A list of revisions, as returned by list_revisions, with the cursor to
+    pass as its after argument to get the following page in next_cursor,
+    or None if this is the last page.
+    """
+
+    next_cursor = None
+
+    def __init__(self, revisions=(), next_cursor=None):
+        super(RevisionPage, self).__init__(revisions)
+        self.next_cursor = next_cursor
+
+
+class AsyncBackend(object):
+    """
+    The async API of the backends: each method runs the blocking method of
+    the same name, without the leading a, with the executor of the
+    document (see vff.executor), and returns a future for its result.
+    Reads run in parallel and writes one after the other.
+
+    It is part of VFFBackend; backends that are registered as VFFBackends
+    rather than subclassing it can inherit it from here.
+    """
+
+    def get_executor(self, instance):
+        """
+        return the vff.executor.RepoExecutor that runs the async calls about
+        the document of instance. Backends with a repository should
+        override this to return the executor of that repository; the
+        default implementation uses one for each backend class.
+
+        params:
+        - instance: The django model object corresponding to this content
+        """
+        return get_executor(self.__class__)
+
+    def alist_revisions(self, instance, count=0, offset=0, after=None):
+        return self.get_executor(instance).read(
+            self.list_revisions, instance, count=count, offset=offset,
+            after=after)
+
+    def acount_revisions(self, instance):
+        return self.get_executor(instance).read(self.count_revisions,
+                                                instance)
+
+    def aget_revision(self, instance, rev=None):
+        return self.get_executor(instance).read(self.get_revision, instance,
+                                                rev=rev)
+
+    def aget_diff(self, instance, id1, id2, **options):
+        return self.get_executor(instance).read(self.get_diff, instance, id1,
+                                                id2, **options)
+
+    def aadd_revision(self, content, instance, commit_msg, username,
+                      callback=None):
+        return self.get_executor(instance).write(
+            self.add_revision, content, instance, commit_msg, username,
+            callback=callback)
+
+    def adel_document(self, instance, commit_msg, username, callback=None):
+        return self.get_executor(instance).write(
+            self.del_document, instance, commit_msg, username,
+            callback=callback)
+
+
+class VFFBackend(AsyncBackend):
 
     __metaclass__ = ABCMeta
 
@@ -54,33 +123,92 @@ class VFFBackend(object):
         """
 
     @abstractmethod
-    def add_revision(self, content, instance, commit_msg, username):
+    def add_revision(self, content, instance, commit_msg, username,
+                     callback=None):
         """
         Add a new revision to an existing document, or add a new document
         to the repository.
 
+        Return the versionid of the new revision or, if the backend commits
+        asynchronously, an object with a result() method that blocks until
+        the revision is durable and then returns its versionid.
+
         params:
         - content: A file like object that implements open, seek, read, close
                   and contains the document data to be versioned
         - instance: The django model object corresponding to this content
         - commit_msg: A string with the commit msg
         - username: A username to commit with
+        - callback: An optional callable, that will be called with the
+                   versionid once the revision is durable
         """
 
     @abstractmethod
-    def del_document(self, instance, commit_msg):
+    def del_document(self, instance, commit_msg, username, callback=None):
         """
-        Remove document from the repository.
+        Remove document from the repository. Return as add_revision.
 
         params:
         - instance: The django model object corresponding to this content
         - commit_msg: A string with the commit msg
+        - username: A username to commit with
+        - callback: An optional callable, that will be called with the
+                   versionid once the removal is durable
+        """
+
+    def bulk_add_revisions(self, revisions, commit_msg, username,
+                           callback=None):
+        """
+        Add a new revision to each of many documents, all with the same
+        commit message and author. Return the versionid of the last
+        revision added, as soon as it is durable, or None if there were no
+        revisions. Backends should override this to commit them all at
+        once; the default implementation adds them one by one.
+
+        params:
+        - revisions: An iterable of (instance, content) tuples, as the
+                    params of add_revision
+        - commit_msg: A string with the commit msg
+        - username: A username to commit with
+        - callback: An optional callable, that will be called with the
+                   versionid once the revisions are durable
+        """
+        return self._bulk(self.add_revision,
+                          [(content, instance)
+                           for instance, content in revisions],
+                          commit_msg, username, callback)
+
+    def bulk_del_documents(self, instances, commit_msg, username,
+                           callback=None):
+        """
+        Remove many documents from the repository. Return as
+        bulk_add_revisions.
+
+        params:
+        - instances: An iterable of django model objects
+        - commit_msg: A string with the commit msg
+        - username: A username to commit with
+        - callback: An optional callable, that will be called with the
+                   versionid once the removals are durable
         """
+        return self._bulk(self.del_document,
+                          [(instance,) for instance in instances],
+                          commit_msg, username, callback)
+
+    def _bulk(self, method, calls, commit_msg, username, callback):
+        versionid = None
+        for args in calls:
+            versionid = method(*(args + (commit_msg, username)))
+        if hasattr(versionid, 'result'):
+            versionid = versionid.result()
+        if callback is not None and versionid is not None:
+            callback(versionid)
+        return versionid
 
     @abstractmethod
-    def list_revisions(self, instance, count=0, offset=0):
+    def list_revisions(self, instance, count=0, offset=0, after=None):
         """
-        return a list of all (or from offset to offset+count) revisions of a document. A revision is here
+        return a RevisionPage (see below) with all (or from offset to offset+count) revisions of a document. A revision is here
         represented by a dictionary with keys:
             * versionid: A string that uniquelly identifies a version for the document, and can be used
                          as parameter for self.get_revision (below)
@@ -92,6 +220,18 @@ class VFFBackend(object):
         - instance: The django model object corresponding to this content
         - count: The number of revisions to list. -1 for all.
         - offset: The number of revisions skipped from the list
+        - after: A cursor, the next_cursor of a previous page: list only
+                 the revisions older than those in that page.
+        """
+
+    @abstractmethod
+    def count_revisions(self, instance):
+        """
+        return the number of revisions of a document, without listing
+        them.
+
+        params:
+        - instance: The django model object corresponding to this content
         """
 
     @abstractmethod
@@ -105,12 +245,95 @@ class VFFBackend(object):
         - rev: the id of the revision to get. If None, get the last.
         """
 
+    def check(self):
+        """
+        return a list of strings describing the problems with the
+        configuration of the backend or with its repository, for django's
+        system checks. Backends should not open their repository before
+        their first use, nor create or change anything here; the default
+        implementation finds none.
+        """
+        return []
+
+    def open_revision(self, instance, rev=None):
+        """
+        return a binary, read only file like object with the content of the
+        revision specified by id. If id is None, the last revision.
+        Backends should override this to read the content lazily; the
+        default implementation holds it all in memory.
+
+        params:
+        - instance: The django model object corresponding to this content
+        - rev: the id of the revision to get. If None, get the last.
+        """
+        return BytesIO(self.get_revision(instance, rev=rev).encode('utf8'))
+
+    def prefetch_revisions(self, instances, rev=None, metadata=True):
+        """
+        return a dictionary mapping the pk of each of the given instances
+        to a (content, latest) tuple: content is the revision rev of its
+        document, as returned by get_revision (or None if it cannot be
+        had), and latest its latest revision, as returned by
+        list_revisions (or None, if it has none or metadata is false).
+        Backends should override this to fetch them all at once; the
+        default implementation asks for each document in turn.
+
+        params:
+        - instances: An iterable of django model objects
+        - rev: the id of the revision to get. If None, get the last.
+        - metadata: whether to get the latest revision of each document.
+        """
+        prefetched = {}
+        for instance in instances:
+            latest = None
+            if metadata:
+                revs = self.list_revisions(instance, count=1)
+                latest = revs and revs[0] or None
+            prefetched[instance.pk] = (self.get_revision(instance, rev=rev),
+                                       latest)
+        return prefetched
+
+    def latest_metadata(self, instances):
+        """
+        return a dictionary mapping the pk of each of the given instances
+        to a (latest, size, count) tuple: latest is its latest revision, as
+        returned by list_revisions (or None if it has none), size the size
+        in bytes of its latest content (or None if it was removed or has
+        none), and count its number of revisions. Backends should override
+        this to find them all at once; the default implementation asks for
+        each document in turn.
+
+        params:
+        - instances: An iterable of django model objects
+        """
+        get_size = getattr(self, 'get_size', None)
+        metadata = {}
+        for instance in instances:
+            revs = self.list_revisions(instance, count=1)
+            latest = revs and revs[0] or None
+            size = None
+            if latest is not None and get_size is not None:
+                try:
+                    size = get_size(self.get_filename(instance))
+                except (OSError, KeyError):
+                    # removed
+                    pass
+            metadata[instance.pk] = (latest, size,
+                                     self.count_revisions(instance))
+        return metadata
+
     @abstractmethod
-    def get_diff(self, instance, id1, id2):
+    def get_diff(self, instance, id1, id2, **options):
         """
         return a diff between two revisions, as an utf8 string.
 
+        Backends should compute it with a vff.diff.DiffEngine (see
+        vff.diff.get_engine), and accept the options documented there,
+        e.g. context=3, ignore_whitespace=False, word_diff=False,
+        structured=False.
+
         params:
         - instance: The django model object corresponding to this content
         - id1, id2: the ids of the revisions to diff.
+        - options: keyword arguments for the diff engine.
         """
@@ -0,0 +1,179 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    # django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+
+def sizeof(value):
+    """
+    Return the size of value, as reported by sys.getsizeof, plus those of
+    the items of the lists, tuples and dictionaries in it (e.g. structured
+    diffs).
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(sizeof(item) for item in value)
+    return size
+
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache, that holds values up to a
+    total size of max_bytes (as reported by sizeof).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = (value, size)
+            return value
+
+    def set(self, key, value):
+        size = sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.size -= evicted
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class RevisionCache(object):
+    """
+    Cache for the contents of revisions and for diffs between them.
+
+    The content of a path in a given commit never changes, so cached values
+    never need to be invalidated. There are two tiers: an in process
+    LRUCache, of VFF_CACHE_SIZE bytes, and optionally the django cache
+    named by VFF_CACHE, shared among processes. Keys are tuples of strings,
+    that must include the (full) ids of the commits involved.
+    """
+
+    def __init__(self, max_bytes, alias=None):
+        self.local = None
+        self.shared = None
+        if max_bytes:
+            self.local = LRUCache(max_bytes)
+        if alias:
+            self.shared = get_cache(alias)
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Return a RevisionCache configured from the django settings, or None
+        if both tiers are disabled.
+        """
+        max_bytes = getattr(settings, 'VFF_CACHE_SIZE', 16 * 1024 * 1024)
+        alias = getattr(settings, 'VFF_CACHE', None)
+        if not max_bytes and not alias:
+            return None
+        return cls(max_bytes, alias)
+
+    def _shared_key(self, key):
+        key = u'\x00'.join(key).encode('utf8')
+        return 'vff:' + hashlib.sha1(key).hexdigest()
+
+    def get(self, key):
+        """
+        Return the value cached for key, or None.
+        """
+        if self.local is not None:
+            value = self.local.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+        if self.shared is not None:
+            value = self.shared.get(self._shared_key(key))
+            if value is not None:
+                self.shared_hits += 1
+                if self.local is not None:
+                    self.local.set(key, value)
+                return value
+            self.shared_misses += 1
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        if self.local is not None:
+            self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(self._shared_key(key), value, None)
+
+    def stats(self):
+        """
+        Return a dictionary with the hit and miss counters of the cache,
+        and the number and size of the values held in process.
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'shared_hits': self.shared_hits,
+                'shared_misses': self.shared_misses,
+                'entries': self.local is not None and len(self.local) or 0,
+                'bytes': self.local is not None and self.local.size or 0}
@@ -0,0 +1,466 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import re
+import zlib
+import errno
+import heapq
+import uuid
+import hashlib
+import datetime
+import threading
+import git
+from io import BytesIO
+from difflib import SequenceMatcher
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from vff.abcs import RevisionPage, VFFBackend
+from vff.diff import GitDiffEngine, DifflibEngine, get_engine
+from vff.git_backend import get_identity
+from vff.git_objects import find_blobs
+from vff.git_repo import commit_attribution, iter_history
+from vff.git_stream import iter_chunks
+
+# a delta is a sequence of copies of lines of the previous revision,
+# 'c<first>,<last>\n', and of insertions of new bytes, 'i<size>\n<bytes>'
+DELTA_OP = re.compile(r'([ci])(\d+)(?:,(\d+))?\n')
+
+# documents looked up per query, below the 999 parameters sqlite allows
+LOOKUP_BATCH = 500
+
+# sqlite fails transactions that read and then write while another one
+# writes, instead of waiting, so writes to it are serialized in process
+_sqlite_lock = threading.Lock()
+
+
+def make_delta(old, new):
+    """
+    Return a delta that turns the bytes old into the bytes new, as a list
+    of line copies and insertions (see DELTA_OP).
+    """
+    a = old.splitlines(True)
+    b = new.splitlines(True)
+    ops = []
+    matcher = SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append('c%d,%d\n' % (i1, i2))
+        elif j2 > j1:
+            data = ''.join(b[j1:j2])
+            ops.append('i%d\n' % len(data))
+            ops.append(data)
+    return ''.join(ops)
+
+
+def apply_delta(old, delta):
+    """
+    Return the bytes that delta, as returned by make_delta, turns old into.
+    """
+    a = old.splitlines(True)
+    out = []
+    pos = 0
+    while pos < len(delta):
+        match = DELTA_OP.match(delta, pos)
+        if match is None:
+            raise ValueError('Corrupt vff delta at %d.' % pos)
+        pos = match.end()
+        if match.group(1) == 'c':
+            out.extend(a[int(match.group(2)):int(match.group(3))])
+        else:
+            size = int(match.group(2))
+            out.append(delta[pos:pos + size])
+            pos += size
+    return ''.join(out)
+
+
+def to_datetime(timestamp):
+    """
+    Return the datetime, as django stores them, of a unix timestamp.
+    """
+    if settings.USE_TZ:
+        return datetime.datetime.utcfromtimestamp(timestamp).replace(
+            tzinfo=timezone.utc)
+    return datetime.datetime.fromtimestamp(timestamp)
+
+
+class _NoLock(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class DBBackend(VFFBackend):
+    """
+    Backend that keeps the documents in the database, in the models of the
+    vff app (which has to be installed), through the connection named
+    VFF_DB_ALIAS ('default' by default).
+
+    The latest content of each document is kept in full in its Document
+    row. Its revisions are kept as zlib compressed deltas from the previous
+    revision, with a full snapshot every VFF_DB_SNAPSHOT_INTERVAL (16)
+    revisions, so rebuilding an old revision applies at most that many
+    deltas. Versionids are random, as long as git commit ids, and shared by
+    the documents written at once.
+    See abcs.py for documentation.
+    """
+
+    def __init__(self, fieldname):
+        self.fieldname = fieldname
+        self.sublocation = getattr(settings, 'VFF_REPO_PATH', '')
+        self.using = getattr(settings, 'VFF_DB_ALIAS', 'default')
+        self.snapshot_interval = getattr(settings,
+                                         'VFF_DB_SNAPSHOT_INTERVAL', 16)
+        self.skip_unchanged = getattr(settings, 'VFF_SKIP_UNCHANGED', True)
+        # writes not made because they left their document unchanged
+        self.skipped_writes = 0
+        engine = get_engine()
+        if isinstance(engine, GitDiffEngine):
+            # there are no blobs to give to git
+            engine = DifflibEngine(engine.max_bytes, engine.timeout)
+        self.diff_engine = engine
+
+    @property
+    def documents(self):
+        return apps.get_model('vff', 'Document')._default_manager.using(
+            self.using)
+
+    @property
+    def revisions(self):
+        return apps.get_model('vff', 'Revision')._default_manager.using(
+            self.using)
+
+    def check(self):
+        if not apps.is_installed('vff'):
+            return ["DBBackend needs 'vff' in INSTALLED_APPS."]
+        return []
+
+    def get_filename(self, instance):
+        # the same as in the git backend, so that migrated documents
+        # keep their names
+        class_name = instance.__class__.__name__.lower()
+        name = '%s%s-%s.xml' % (class_name, instance.pk, self.fieldname)
+        if self.sublocation:
+            return '%s/%s' % (self.sublocation, name)
+        return name
+
+    def add_revision(self, content, instance, commit_msg, username,
+                     callback=None):
+        return self.bulk_add_revisions([(instance, content)], commit_msg,
+                                       username, callback)
+
+    def del_document(self, instance, commit_msg, username, callback=None):
+        return self.bulk_del_documents([instance], commit_msg, username,
+                                       callback)
+
+    def bulk_add_revisions(self, revisions, commit_msg, username,
+                           callback=None):
+        # the last content of each document
+        changes = dict((self.get_filename(instance),
+                        ''.join(iter_chunks(content)))
+                       for instance, content in revisions)
+        return self._write(changes, commit_msg, username, callback)
+
+    def bulk_del_documents(self, instances, commit_msg, username,
+                           callback=None):
+        changes = dict((self.get_filename(instance), None)
+                       for instance in instances)
+        return self._write(changes, commit_msg, username, callback)
+
+    def _write(self, changes, commit_msg, username, callback):
+        """
+        Write changes, a dictionary mapping fnames to their new content,
+        or to None to remove them, in a single transaction, as revisions
+        with the same versionid. Return the versionid.
+        """
+        if not changes:
+            return None
+        # random, but as long as a git commit id
+        versionid = hashlib.sha1(uuid.uuid4().bytes).hexdigest()
+        author = get_identity(username).name
+        date = timezone.now()
+        with self._write_lock():
+            with transaction.atomic(using=self.using):
+                written = 0
+                for fname, content in sorted(changes.items()):
+                    if self.store_revision(fname, content, versionid,
+                                           author, commit_msg, date):
+                        written += 1
+        if written < len(changes):
+            self.skipped_writes += len(changes) - written
+            if not written:
+                versionid = self._existing(changes)
+        if callback is not None:
+            callback(versionid)
+        return versionid
+
+    def _write_lock(self):
+        if connections[self.using].vendor == 'sqlite':
+            return _sqlite_lock
+        return _NoLock()
+
+    def _existing(self, changes):
+        """
+        Return the versionid of the latest revision of the documents in
+        changes, none of which has changed.
+        """
+        revs = self.revisions.filter(document__fname__in=list(changes),
+                                     number=F('document__revcount'))
+        revs = revs.order_by('-date', '-id').values_list('versionid',
+                                                         flat=True)[:1]
+        return revs and revs[0] or None
+
+    def store_revision(self, fname, content, versionid, author, message,
+                       date):
+        """
+        Add a revision of fname, with content (bytes), or removing it if
+        content is None, within a transaction. Return False if it was not
+        added, because it would leave fname unchanged.
+        """
+        Revision = apps.get_model('vff', 'Revision')
+        document, created = self.documents.select_for_update(
+        ).get_or_create(fname=fname)
+        previous = document.content
+        if previous is not None:
+            previous = bytes(previous)
+        if content is None and previous is None:
+            if not document.revcount:
+                document.delete()
+            return False
+        if (content is not None and content == previous and
+                self.skip_unchanged):
+            return False
+        number = document.revcount + 1
+        if content is None:
+            kind, data, size = Revision.REMOVED, '', None
+        else:
+            size = len(content)
+            kind, data = Revision.SNAPSHOT, content
+            if (previous is not None and
+                    number - document.snapshot < self.snapshot_interval):
+                delta = make_delta(previous, content)
+                if len(delta) < len(content):
+                    kind, data = Revision.DELTA, delta
+        if kind == Revision.SNAPSHOT:
+            document.snapshot = number
+        self.revisions.create(document=document, number=number,
+                              versionid=versionid, author=author[:255],
+                              message=message, date=date, kind=kind,
+                              data=zlib.compress(data), size=size)
+        document.content = content
+        document.revcount = number
+        document.save(using=self.using)
+        return True
+
+    def _revision(self, row):
+        versionid, author, message, date = row
+        return {'versionid': versionid,
+                'author': author,
+                'message': message,
+                'date': date}
+
+    def _find(self, fname, rev, *fields):
+        """
+        Return the values of fields of the revision rev of fname, which
+        can be given by a prefix of its versionid, as git allows. Raise
+        ValueError if there is no such revision.
+        """
+        revs = self.revisions.filter(document__fname=fname)
+        found = revs.filter(versionid=rev).values_list(*fields)
+        if not found and len(rev) >= 4:
+            found = revs.filter(versionid__startswith=rev).values_list(
+                *fields)[:2]
+            if len(found) > 1:
+                found = []
+        if not found:
+            raise ValueError('%s has no revision %s' % (fname, rev))
+        return found[0]
+
+    def list_revisions(self, instance, count=0, offset=0, after=None):
+        fname = self.get_filename(instance)
+        revs = self.revisions.filter(document__fname=fname)
+        if after is not None:
+            number, = self._find(fname, after, 'number')
+            revs = revs.filter(number__lt=number)
+        revs = revs.order_by('-number').values_list('versionid', 'author',
+                                                    'message', 'date')
+        if count < 0:
+            # all of them
+            count = 0
+        if count:
+            # one more than count, to tell whether there is a next page
+            revs = revs[offset:offset + count + 1]
+        elif offset:
+            revs = revs[offset:]
+        revs = [self._revision(row) for row in revs]
+        cursor = None
+        if count and len(revs) > count:
+            revs = revs[:count]
+            cursor = revs[-1]['versionid']
+        return RevisionPage(revs, cursor)
+
+    def count_revisions(self, instance):
+        counts = self.documents.filter(
+            fname=self.get_filename(instance)).values_list('revcount',
+                                                           flat=True)
+        return counts and counts[0] or 0
+
+    def _read(self, fname, rev=None):
+        """
+        Return the content of fname, as bytes, in the revision rev, or in
+        the latest if None. Raise ValueError if there is no such revision
+        of fname.
+        """
+        Revision = apps.get_model('vff', 'Revision')
+        if not rev:
+            contents = self.documents.filter(fname=fname).values_list(
+                'content', flat=True)
+            if not contents or contents[0] is None:
+                return ''
+            return bytes(contents[0])
+        revs = self.revisions.filter(document__fname=fname)
+        number, kind = self._find(fname, rev, 'number', 'kind')
+        if kind == Revision.REMOVED:
+            raise ValueError('%s was removed in %s' % (fname, rev))
+        # the closest snapshot, and the deltas from it
+        base = revs.filter(number__lte=number, kind=Revision.SNAPSHOT)
+        base = base.order_by('-number').values_list('number', flat=True)[0]
+        chain = revs.filter(number__gte=base, number__lte=number)
+        content = ''
+        for kind, data in chain.order_by('number').values_list('kind',
+                                                               'data'):
+            data = zlib.decompress(bytes(data))
+            if kind == Revision.SNAPSHOT:
+                content = data
+            else:
+                content = apply_delta(content, data)
+        return content
+
+    def get_revision(self, instance, rev=None):
+        return self._read(self.get_filename(instance), rev).decode('utf8')
+
+    def open_revision(self, instance, rev=None):
+        return BytesIO(self._read(self.get_filename(instance), rev))
+
+    def get_size(self, fname, rev=None):
+        if not rev:
+            contents = self.documents.filter(fname=fname).values_list(
+                'content', flat=True)
+            if not contents or contents[0] is None:
+                raise OSError(errno.ENOENT, 'No vff document %s' % fname)
+            return len(contents[0])
+        size, = self._find(fname, rev, 'size')
+        return size or 0
+
+    def prefetch_revisions(self, instances, rev=None, metadata=True):
+        if rev is not None:
+            return super(DBBackend, self).prefetch_revisions(
+                instances, rev=rev, metadata=metadata)
+        instances = list(instances)
+        fnames = dict((self.get_filename(instance), instance.pk)
+                      for instance in instances)
+        prefetched = dict((instance.pk, (u'', None))
+                          for instance in instances)
+        for fname, content in self.documents.filter(
+                fname__in=list(fnames)).values_list('fname', 'content'):
+            content = content is not None and bytes(content) or ''
+            prefetched[fnames[fname]] = (content.decode('utf8'), None)
+        if metadata:
+            revs = self.revisions.filter(document__fname__in=list(fnames),
+                                         number=F('document__revcount'))
+            for row in revs.values_list('document__fname', 'versionid',
+                                        'author', 'message', 'date'):
+                pk = fnames[row[0]]
+                prefetched[pk] = (prefetched[pk][0],
+                                  self._revision(row[1:]))
+        return prefetched
+
+    def latest_metadata(self, instances):
+        fnames = dict((self.get_filename(instance), instance.pk)
+                      for instance in instances)
+        metadata = dict((pk, (None, None, 0)) for pk in fnames.values())
+        wanted = sorted(fnames)
+        for start in range(0, len(wanted), LOOKUP_BATCH):
+            # removals have no size
+            revs = self.revisions.filter(
+                document__fname__in=wanted[start:start + LOOKUP_BATCH],
+                number=F('document__revcount'))
+            for row in revs.values_list('document__fname', 'versionid',
+                                        'author', 'message', 'date', 'size',
+                                        'document__revcount'):
+                metadata[fnames[row[0]]] = (self._revision(row[1:5]), row[5],
+                                            row[6])
+        return metadata
+
+    def get_diff(self, instance, id1, id2, **options):
+        return self.diff_engine.diff(self, instance, id1, id2, **options)
+
+
+def import_history(sources, backend):
+    """
+    Copy the documents in the git repositories at sources, with all their
+    history, into backend, a DBBackend, in chronological order, keeping
+    the versionids, authors, messages and dates of the commits. Files that
+    are not documents (e.g. READMEs) are left out. Return the number of
+    revisions copied.
+    """
+    repos = [git.Repo(source) for source in sources]
+
+    def history(n, repo):
+        try:
+            repo.head.commit
+        except ValueError:
+            # no commits
+            return
+        for seq, (commit, paths) in enumerate(iter_history(repo)):
+            yield commit.committed_date, n, seq, repo, commit, paths
+    histories = [history(n, repo) for n, repo in enumerate(repos)]
+    count = 0
+    for date, n, seq, repo, commit, paths in heapq.merge(*histories):
+        paths = [path for path in paths if path.endswith('.xml')]
+        if not paths:
+            continue
+        found = find_blobs(repo.odb, commit.tree.binsha, paths)
+        with transaction.atomic(using=backend.using):
+            for path in paths:
+                content = None
+                if path in found:
+                    content = repo.odb.stream(found[path]).read()
+                author, message = commit_attribution(commit, path)
+                if backend.store_revision(path, content, commit.hexsha,
+                                          author, message,
+                                          to_datetime(date)):
+                    count += 1
+    return count
@@ -0,0 +1,321 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import re
+import difflib
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+HUNKPAT = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+WORDPAT = re.compile(r'(\s*)(\S+)', re.UNICODE)
+
+
+class DiffTooLarge(Exception):
+    """
+    The diff would exceed the size or time limits (VFF_DIFF_MAX_BYTES and
+    VFF_DIFF_TIMEOUT).
+    """
+
+
+def _hunk_header(start1, len1, start2, len2):
+    def fmt(start, length):
+        if length == 1:
+            return '%d' % start
+        if not length:
+            start -= 1
+        return '%d,%d' % (start, length)
+    return '@@ -%s +%s @@' % (fmt(start1, len1), fmt(start2, len2))
+
+
+def _word_segments(old, new):
+    """
+    Return the word diff between the lists of lines old and new, as lines
+    in the format of git diff --word-diff=porcelain: segments prefixed by
+    ' ', '-' or '+', and a '~' at the end of each line.
+    """
+    out = []
+
+    def emit(op, text):
+        parts = text.split(u'\n')
+        for i, part in enumerate(parts):
+            if part:
+                out.append(op + part)
+            if i < len(parts) - 1:
+                out.append(u'~')
+    # words are compared ignoring the whitespace before them
+    words1 = WORDPAT.findall(u'\n'.join(old))
+    words2 = WORDPAT.findall(u'\n'.join(new))
+    matcher = difflib.SequenceMatcher(None, [w for _, w in words1],
+                                      [w for _, w in words2], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            emit(u' ', u''.join(s + w for s, w in words1[i1:i2]))
+            continue
+        changed1 = words1[i1:i2]
+        changed2 = words2[j1:j2]
+        space = (changed1 or changed2)[0][0]
+        emit(u' ', space)
+        if changed1:
+            emit(u'-', u''.join(s + w for s, w in changed1)[len(space):])
+        if changed2:
+            emit(u'+', u''.join(s + w for s, w in changed2)[len(changed2[0][0]):])
+    out.append(u'~')
+    return out
+
+
+def parse_hunks(lines, word_diff=False):
+    """
+    Parse the hunks of a unified diff (or of a porcelain word diff) into a
+    list of dictionaries with keys old_start, old_lines, new_start,
+    new_lines and lines. For line diffs, lines is a list of (op, text)
+    tuples, with op one of ' ', '-' or '+'. For word diffs, it is a list
+    with a list of such tuples for each line.
+    """
+    hunks = []
+    hunk = None
+    line = []
+    for text in lines:
+        text = text.rstrip(u'\n')
+        m = HUNKPAT.match(text)
+        if m:
+            hunk = {'old_start': int(m.group(1)),
+                    'old_lines': int(m.group(2) or 1),
+                    'new_start': int(m.group(3)),
+                    'new_lines': int(m.group(4) or 1),
+                    'lines': []}
+            hunks.append(hunk)
+        elif hunk is None or not text or text[0] not in u' -+~':
+            continue
+        elif not word_diff:
+            hunk['lines'].append((text[0], text[1:]))
+        elif text == u'~':
+            hunk['lines'].append(line)
+            line = []
+        else:
+            line.append((text[0], text[1:]))
+    return hunks
+
+
+def render_word_diff(lines):
+    """
+    Render a porcelain word diff as git diff --word-diff=plain does.
+    """
+    out = []
+    line = []
+    marks = {u' ': u'%s', u'-': u'[-%s-]', u'+': u'{+%s+}'}
+    for text in lines:
+        if text and text[0] in marks and not HUNKPAT.match(text):
+            line.append(marks[text[0]] % text[1:])
+        elif text == u'~':
+            out.append(u''.join(line))
+            line = []
+        else:
+            out.append(text)
+    return out
+
+
+class DiffEngine(object):
+    """
+    Base class for diff engines. Subclasses implement diff, that returns
+    the diff between two revisions of a document, given the options:
+
+    - context: number of lines of context around each change.
+    - ignore_whitespace: ignore whitespace when comparing lines, as
+      git diff -w does.
+    - word_diff: diff words instead of lines, and mark the changes inline
+      as [-removed-] and {+added+}.
+    - structured: return a list of hunks (see parse_hunks) instead of a
+      string.
+    - algorithm: for engines that support several, the diff algorithm.
+    """
+
+    def __init__(self, max_bytes=None, timeout=None):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+    def diff(self, backend, instance, r1, r2, context=3,
+             ignore_whitespace=False, word_diff=False, structured=False,
+             algorithm=None):
+        raise NotImplementedError
+
+    def _output(self, header, lines, word_diff, structured):
+        if structured:
+            return parse_hunks(lines, word_diff)
+        if word_diff:
+            lines = render_word_diff(lines)
+        return u'\n'.join(header + lines)
+
+
+class DifflibEngine(DiffEngine):
+    """
+    Diff engine based on python's difflib, that works with any backend.
+    Since it runs in pure python, VFF_DIFF_TIMEOUT cannot interrupt it;
+    only VFF_DIFF_MAX_BYTES, checked on the sizes of the revisions,
+    protects against pathological diffs.
+    """
+
+    def diff(self, backend, instance, r1, r2, context=3,
+             ignore_whitespace=False, word_diff=False, structured=False,
+             algorithm=None):
+        text1 = backend.get_revision(instance, r1)
+        text2 = backend.get_revision(instance, r2)
+        if self.max_bytes and (len(text1.encode('utf8')) +
+                               len(text2.encode('utf8')) > self.max_bytes):
+            raise DiffTooLarge('The revisions are too large to diff.')
+        md1 = text1.split(u'\n')
+        md2 = text2.split(u'\n')
+        header = [u'--- %s\n' % r1, u'+++ %s\n' % r2]
+        if ignore_whitespace:
+            norm1 = [u''.join(l.split()) for l in md1]
+            norm2 = [u''.join(l.split()) for l in md2]
+        else:
+            norm1, norm2 = md1, md2
+        matcher = difflib.SequenceMatcher(None, norm1, norm2)
+        lines = []
+        for group in matcher.get_grouped_opcodes(context):
+            first, last = group[0], group[-1]
+            lines.append(_hunk_header(first[1] + 1, last[2] - first[1],
+                                      first[3] + 1, last[4] - first[3])
+                         + u'\n')
+            removed, added = [], []
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    if word_diff:
+                        if removed or added:
+                            lines.extend(_word_segments(removed, added))
+                            removed, added = [], []
+                        for l in md1[i1:i2]:
+                            lines.extend([u' ' + l, u'~'])
+                    else:
+                        lines.extend(u' ' + l for l in md1[i1:i2])
+                    continue
+                if word_diff:
+                    removed.extend(md1[i1:i2])
+                    added.extend(md2[j1:j2])
+                else:
+                    lines.extend(u'-' + l for l in md1[i1:i2])
+                    lines.extend(u'+' + l for l in md2[j1:j2])
+            if removed or added:
+                lines.extend(_word_segments(removed, added))
+        if not lines:
+            return structured and [] or u''
+        return self._output(header, lines, word_diff, structured)
+
+
+class GitDiffEngine(DiffEngine):
+    """
+    Diff engine that runs git's own blob to blob diff, in C, with the
+    patience or histogram algorithms available. It only works with the git
+    backend, and falls back to DifflibEngine to diff the working copy of
+    a document (rev None) in non bare repositories. The git process is
+    killed if it runs for longer than VFF_DIFF_TIMEOUT seconds, or if its
+    output exceeds VFF_DIFF_MAX_BYTES.
+    """
+
+    def diff(self, backend, instance, r1, r2, context=3,
+             ignore_whitespace=False, word_diff=False, structured=False,
+             algorithm=None):
+        fname = backend.get_filename(instance)
+        sha1 = backend.blob_hexsha(fname, r1)
+        sha2 = backend.blob_hexsha(fname, r2)
+        if sha1 is None or sha2 is None:
+            fallback = DifflibEngine(self.max_bytes, self.timeout)
+            return fallback.diff(backend, instance, r1, r2, context,
+                                 ignore_whitespace, word_diff, structured)
+        args = ['--no-color', '--no-ext-diff', '-U%d' % context,
+                '--diff-algorithm=%s' % (algorithm or 'myers')]
+        if ignore_whitespace:
+            args.append('-w')
+        if word_diff:
+            args.append('--word-diff=porcelain')
+        output = self._run(backend.repo, args + [sha1, sha2])
+        lines = output.decode('utf8').split(u'\n')
+        if lines and not lines[-1]:
+            lines.pop()
+        for i, line in enumerate(lines):
+            if line.startswith(u'@@'):
+                break
+        else:
+            return structured and [] or u''
+        lines = lines[i:]
+        for i, line in enumerate(lines):
+            m = HUNKPAT.match(line)
+            if m:
+                lines[i] = m.group(0) + u'\n'
+        header = [u'--- %s\n' % r1, u'+++ %s\n' % r2]
+        return self._output(header, lines, word_diff, structured)
+
+    def _run(self, repo, args):
+        cmd = repo.git.diff(*args, as_process=True)
+        proc = cmd.proc
+        timer = None
+        timed_out = []
+        if self.timeout:
+            def kill():
+                timed_out.append(True)
+                proc.kill()
+            timer = threading.Timer(self.timeout, kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            chunks = []
+            size = 0
+            while True:
+                chunk = proc.stdout.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if self.max_bytes and size > self.max_bytes:
+                    proc.kill()
+                    raise DiffTooLarge('The diff is too large.')
+                chunks.append(chunk)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+            cmd.proc = None
+        if timed_out:
+            raise DiffTooLarge('The diff took too long.')
+        return b''.join(chunks)
+
+
+def get_engine():
+    """
+    Return an instance of the diff engine pointed at by VFF_DIFF_ENGINE.
+    """
+    path = getattr(settings, 'VFF_DIFF_ENGINE', 'vff.diff.DifflibEngine')
+    mname = '.'.join(path.split('.')[:-1])
+    cname = path.split('.')[-1]
+    engine_class = getattr(import_module(mname), cname)
+    return engine_class(
+        max_bytes=getattr(settings, 'VFF_DIFF_MAX_BYTES', 10 * 2 ** 20),
+        timeout=getattr(settings, 'VFF_DIFF_TIMEOUT', 10))
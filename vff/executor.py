@@ -0,0 +1,190 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import os
+import Queue
+import atexit
+import threading
+
+from django.conf import settings
+
+from vff.group_commit import CommitFuture
+
+try:
+    # the futures backport, if installed
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    Future = CommitFuture
+    ThreadPoolExecutor = None
+
+
+class ThreadPool(object):
+    """
+    A minimal stand in for concurrent.futures.ThreadPoolExecutor, for when
+    the futures backport is not installed. Its futures are CommitFutures,
+    which have the same interface.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Cannot submit to a vff pool after'
+                                   ' shutdown.')
+            self._queue.put((future, fn, args, kwargs))
+            if len(self._threads) < min(self.max_workers,
+                                        self._queue.qsize()):
+                thread = threading.Thread(target=self._run,
+                                          name='vff-executor')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+def _pool(max_workers):
+    if ThreadPoolExecutor is not None:
+        return ThreadPoolExecutor(max_workers)
+    return ThreadPool(max_workers)
+
+
+class RepoExecutor(object):
+    """
+    Runs the calls of the async API about the documents of a repository
+    in threads: reads in a pool of up to readers threads (VFF_ASYNC_READERS,
+    4 by default), in parallel, and writes in a single thread, one after
+    the other.
+    """
+
+    def __init__(self, readers=None):
+        if readers is None:
+            readers = getattr(settings, 'VFF_ASYNC_READERS', 4)
+        self._readers = _pool(readers)
+        self._writer = _pool(1)
+
+    def read(self, fn, *args, **kwargs):
+        """
+        Call fn in a reader thread, and return a future for its result.
+        """
+        return self._readers.submit(fn, *args, **kwargs)
+
+    def write(self, fn, *args, **kwargs):
+        """
+        Call fn in the writer thread, after the writes submitted before,
+        and return a future for its result.
+        """
+        return self._writer.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self._readers.shutdown(wait)
+        self._writer.shutdown(wait)
+
+
+def done_future(result):
+    """
+    Return a future that is already done, with result.
+    """
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+_executors_pid = os.getpid()
+
+
+def get_executor(key):
+    """
+    Return the RepoExecutor for key (e.g. the location of a repository),
+    creating it the first time it is asked for in this process.
+    """
+    if _executors_pid != os.getpid():
+        # forked: the threads of the executors stayed in the parent
+        forget_executors()
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None:
+            executor = _executors[key] = RepoExecutor()
+    return executor
+
+
+def forget_executors():
+    """
+    Drop all the executors without shutting them down, in forked
+    processes, where their threads do not exist.
+    """
+    global _executors_lock, _executors_pid
+    _executors_lock = threading.Lock()
+    _executors_pid = os.getpid()
+    _executors.clear()
+
+
+def shutdown_executors():
+    """
+    Shut down all the executors, once the calls submitted to them are done.
+    They are created again on demand.
+    """
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown()
+
+
+atexit.register(shutdown_executors)
@@ -28,11 +28,14 @@
 import uuid
 
 from django.conf import settings
+from django.core import checks
 from django.utils.importlib import import_module
+from django.db import models
 from django.db.models.fields.files import FieldFile, FileField
 
 from vff.storage import VersionedStorage
-from vff.abcs import VFFBackend
+from vff.abcs import RevisionPage, VFFBackend
+from vff.executor import done_future
 
 HAS_SOUTH = True
 try:
@@ -41,8 +44,33 @@ except ImportError:
     HAS_SOUTH = False
 
 
+class LatestPage(RevisionPage):
+    """
+    The first page of one revision, from the prefetched latest revision of
+    a field file. Whether there are older revisions, for its next_cursor,
+    is only asked to the backend when next_cursor is read.
+    """
+
+    def __init__(self, fieldfile, latest):
+        list.__init__(self, [latest])
+        self.fieldfile = fieldfile
+
+    @property
+    def next_cursor(self):
+        if not hasattr(self, '_next_cursor'):
+            versionid = self[0]['versionid']
+            older = self.fieldfile.storage.backend.list_revisions(
+                self.fieldfile.instance, count=1, after=versionid)
+            self._next_cursor = older and versionid or None
+        return self._next_cursor
+
+
 class VersionedFieldFile(FieldFile):
 
+    # set by prefetch_revisions
+    _prefetched_revision = None
+    _prefetched_latest = None
+
     def __init__(self, instance, field, name):
         if instance.pk is None:    # new file
             name = uuid.uuid4().hex
@@ -58,7 +86,9 @@ class VersionedFieldFile(FieldFile):
         else:
             self.name = self.storage.backend.get_filename(self.instance)
             save = False
-        self.storage.save(self.name, content, username, commit_msg, save)
+        self._clear_prefetched()
+        self.storage.save(self.name, content, username, commit_msg, save,
+                          self.instance)
         setattr(self.instance, self.field.name, self.name)
 
         # Update the filesize cache
@@ -72,26 +102,124 @@ class VersionedFieldFile(FieldFile):
         if hasattr(self, '_file'):
             self.close()
             del self.file
-        self.storage.delete(self.name, username, commit_msg, save)
+        self._clear_prefetched()
+        self.storage.delete(self.name, username, commit_msg, save,
+                            self.instance)
 
     delete.alters_data = True
 
-    def list_revisions(self, count=0, offset=0):
+    def _clear_prefetched(self):
+        self._prefetched_revision = None
+        self._prefetched_latest = None
+
+    def _get_size(self):
+        if self.field.latest_columns and not hasattr(self, '_size'):
+            size = getattr(self.instance, self.field.name + '_size')
+            if size is not None:
+                return size
+        return super(VersionedFieldFile, self)._get_size()
+    size = property(_get_size)
+
+    def list_revisions(self, count=0, offset=0, after=None):
+        if (count == 1 and not offset and after is None and
+                self._prefetched_latest is not None and
+                self._prefetched_latest['versionid'] is not None):
+            return LatestPage(self, self._prefetched_latest)
         return self.storage.backend.list_revisions(self.instance,
-                                           count=count, offset=offset)
+                                           count=count, offset=offset,
+                                           after=after)
+
+    def count_revisions(self):
+        return self.storage.backend.count_revisions(self.instance)
+
+    def latest_revision(self):
+        """
+        Return the latest revision, as listed by list_revisions, or None if
+        there are none.
+        """
+        revs = self.list_revisions(count=1)
+        return revs and revs[0] or None
 
     def get_revision(self, rev=None):
+        if (self._prefetched_revision is not None and
+                self._prefetched_revision[0] == rev):
+            return self._prefetched_revision[1]
         return self.storage.backend.get_revision(self.instance, rev=rev)
 
-    def get_diff(self, r1, r2):
-        return self.storage.backend.get_diff(self.instance, r1, r2)
+    def open_revision(self, rev=None):
+        return self.storage.backend.open_revision(self.instance, rev=rev)
+
+    def revision_chunks(self, rev=None, chunk_size=None):
+        """
+        Iterate over the content of a revision in chunks of bytes, reading
+        it lazily, e.g. to serve it with a StreamingHttpResponse.
+        """
+        chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        f = self.open_revision(rev)
+        try:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            f.close()
+
+    def get_diff(self, r1, r2, **options):
+        return self.storage.backend.get_diff(self.instance, r1, r2,
+                                             **options)
+
+    # The async API: these return futures for the results of the methods
+    # above, run in threads, see vff.executor.
+
+    def alist_revisions(self, count=0, offset=0, after=None):
+        if (count == 1 and not offset and after is None and
+                self._prefetched_latest is not None and
+                self._prefetched_latest['versionid'] is not None):
+            return done_future(self.list_revisions(count=1))
+        return self.storage.backend.alist_revisions(self.instance,
+                                                    count=count,
+                                                    offset=offset,
+                                                    after=after)
+
+    def acount_revisions(self):
+        return self.storage.backend.acount_revisions(self.instance)
+
+    def aget_revision(self, rev=None):
+        if (self._prefetched_revision is not None and
+                self._prefetched_revision[0] == rev):
+            return done_future(self._prefetched_revision[1])
+        return self.storage.backend.aget_revision(self.instance, rev=rev)
+
+    def aget_diff(self, r1, r2, **options):
+        return self.storage.backend.aget_diff(self.instance, r1, r2,
+                                              **options)
+
+    def asave(self, content, username, commit_msg=''):
+        """
+        Add content as a new revision of the document of the instance,
+        which must be saved, and store its name; unlike save, the write is
+        not tied to saving the instance. Return a future for the versionid.
+        """
+        self._clear_prefetched()
+        return self.storage.asave(self.instance, content, username,
+                                  commit_msg)
+
+    def adelete(self, username, commit_msg=''):
+        """
+        Remove the document of the instance, leaving the instance alone.
+        Return a future for the versionid.
+        """
+        self._clear_prefetched()
+        return self.storage.adelete(self.instance, username, commit_msg)
 
 
 class VersionedFileField(FileField):
 
     attr_class = VersionedFieldFile
 
-    def __init__(self, name=None, verbose_name=None, storage=None, **kwargs):
+    def __init__(self, name=None, verbose_name=None, storage=None,
+                 latest_columns=False, **kwargs):
         try:
             path = settings.VFF_BACKEND
         except AttributeError:
@@ -106,6 +234,7 @@ class VersionedFileField(FileField):
             raise ValueError('The class pointed at in VFF_BACKEND'
                              ' has to provide the interface defined by'
                              ' vff.abcs.VFFBackend.')
+        self.latest_columns = latest_columns
         vstorage = VersionedStorage(backend_class, name)
         super(VersionedFileField, self).__init__(verbose_name=verbose_name,
                                                  name=name,
@@ -113,17 +242,120 @@ class VersionedFileField(FileField):
                                                  storage=vstorage,
                                                  **kwargs)
 
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(VersionedFileField, self).contribute_to_class(cls, name,
+                                                            **kwargs)
+        # models rendered from migrations never save documents, and have
+        # the latest columns in their migrations
+        if cls.__module__ != '__fake__':
+            self.storage.connect()
+            if self.latest_columns and not cls._meta.abstract:
+                self.add_latest_columns(cls, name)
+
+    def add_latest_columns(self, cls, name):
+        """
+        Add to cls the columns that keep the latest revision of the
+        documents of this field (named after the field, see
+        latest_column_fields), unless already there.
+        """
+        existing = set(f.name for f in cls._meta.local_fields)
+        for suffix, column in latest_column_fields():
+            if name + suffix not in existing:
+                column.contribute_to_class(cls, name + suffix)
+
+    def check(self, **kwargs):
+        errors = super(VersionedFileField, self).check(**kwargs)
+        errors.extend(self._check_backend())
+        return errors
+
+    def _check_backend(self):
+        """
+        Report the problems that the backend finds with its configuration
+        and its repository, which it does not open (or create) for this.
+        """
+        check = getattr(self.storage.backend, 'check', None)
+        if check is None:
+            return []
+        return [checks.Error(problem, hint=None, obj=self, id='vff.E001')
+                for problem in check()]
+
     def deconstruct(self):
         name, path, args, kwargs = super(VersionedFileField, self).deconstruct()
         del kwargs["upload_to"]
+        if self.latest_columns:
+            kwargs['latest_columns'] = True
         return name, path, args, kwargs
 
 
+def latest_column_fields():
+    """
+    Return (suffix, field) tuples with the hidden model fields that keep
+    the latest revision of a versioned file field with latest_columns: its
+    versionid, author, date, the size of the document and the number of
+    revisions.
+    """
+    return [
+        ('_sha', models.CharField(max_length=40, null=True, editable=False)),
+        ('_author', models.CharField(max_length=255, null=True,
+                                     editable=False)),
+        ('_date', models.DateTimeField(null=True, editable=False,
+                                       db_index=True)),
+        ('_size', models.BigIntegerField(null=True, editable=False)),
+        ('_revcount', models.PositiveIntegerField(default=0,
+                                                  editable=False)),
+    ]
+
+
+def versioned_fields():
+    """
+    Iterate over all the versioned file fields in the installed models,
+    yielding a (model, field) tuple for each.
+    """
+    from django.apps import apps
+    for model in apps.get_models():
+        for field in model._meta.fields:
+            if isinstance(field, VersionedFileField):
+                yield model, field
+
+
+def prefetch_revisions(queryset, field, rev=None, metadata=True):
+    """
+    Fetch, all at once, the content of the revision rev (the latest if
+    None) of the documents in the given versioned field (a field or its
+    name) of each of the instances in queryset (or in a list of instances),
+    and their latest revision unless metadata is false. They are attached
+    to each field file, so that its get_revision(rev), latest_revision()
+    and list_revisions(count=1) do not go to the backend again (but for
+    the next_cursor of the latter, or a latest revision still in the write
+    behind spool).
+
+    Return queryset, evaluated.
+    """
+    instances = list(queryset)
+    if not instances:
+        return queryset
+    if not isinstance(field, VersionedFileField):
+        field = instances[0]._meta.get_field(field)
+    prefetched = field.storage.backend.prefetch_revisions(
+        [instance for instance in instances if instance.pk is not None],
+        rev=rev, metadata=metadata)
+    for instance in instances:
+        if instance.pk not in prefetched:
+            continue
+        content, latest = prefetched[instance.pk]
+        fieldfile = getattr(instance, field.name)
+        fieldfile._clear_prefetched()
+        if content is not None:
+            fieldfile._prefetched_revision = (rev, content)
+        fieldfile._prefetched_latest = latest
+    return queryset
+
+
 if HAS_SOUTH:
     add_introspection_rules([
         (
             [VersionedFileField],
             [],
-            {},
+            {'latest_columns': ['latest_columns', {'default': False}]},
         ),
     ], ["^vff\.field\.VersionedFileField"])
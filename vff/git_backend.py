@@ -28,69 +28,234 @@
 
 import os
 import re
+import copy
 import datetime
-import difflib
+import threading
 import git
-from types import MethodType
-from tempfile import NamedTemporaryFile
+from io import BytesIO
+from gitdb.util import bin_to_hex
+from tempfile import TemporaryFile, mkstemp
+from git.index.typ import BaseIndexEntry
 
 from django.conf import settings
+from django.core.files import File
 from django.core.files.move import file_move_safe
 
-from vff.abcs import VFFBackend
+from vff.abcs import AsyncBackend, RevisionPage, VFFBackend
+from vff.diff import get_engine
+from vff.executor import get_executor
+from vff.git_stream import (BlobReader, content_size, iter_chunks,
+                            read_blobs, store_file, write_blob)
+from vff.git_objects import create_commit, find_blobs, update_tree
+from vff.git_repo import (get_shared_repo, change_counts, commit_attribution,
+                          history_revisions, last_changes)
+from vff.group_commit import (COMMITTER_EMAIL, COMMITTER_NAME, CommitQueue,
+                              escape_message, format_group_message)
+from vff.instrumentation import measure, timed
+from vff.revision_index import RevisionIndex
+from vff.spool import Spool
 
 USERPAT = re.compile(ur'^([^<]+) <(.+)>$')
 EMAILPAT = re.compile(ur'^([^@]+)@.+$')
+FULLSHA = re.compile(r'^[0-9a-f]{40}$')
+FILEMODE = 0o100644
+NULLSHA = '0' * 40
+# the id of the empty blob
+EMPTY_BLOB = 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+HEXSHA = re.compile(r'^[0-9a-f]{4,40}$')
+# prefix of the cursors of list_revisions for writes still in the spool
+PENDING = 'pending:'
 
-GITCONFIG = u'''\
-[user]
- name = %s
- email = %s
-'''
+_identities = {}
+# held while a backend opens its repository
+_setup_lock = threading.RLock()
 
-def clean_environment():
-    for env in ('USER', 'USERNAME',
-            'GIT_AUTHOR_NAME', 'GIT_AUTHOR_EMAIL',
-            'GIT_COMMITTER_NAME', 'GIT_COMMITTER_EMAIL',
-            'GIT_AUTHOR_DATE', 'GIT_COMMITER_DATE'):
-        if env in os.environ:
-            del os.environ[env]
-    os.environ['USERNAME'] = 'dummy@dummy'
+
+def get_identity(username):
+    """
+    Return the git.Actor to commit as username. Usernames are parsed only
+    once, the actors are cached and shared by all threads.
+    """
+    actor = _identities.get(username)
+    if actor is None:
+        mu = USERPAT.match(username)
+        me = EMAILPAT.match(username)
+        if mu:
+            actor = git.Actor(mu.group(1), mu.group(2))
+        elif me:
+            actor = git.Actor(me.group(1), me.group(0))
+        else:
+            actor = git.Actor(username, username)
+        _identities[username] = actor
+    return actor
 
 
-class Repo(git.Repo):
+def existing_parent(path):
     """
-    This class is only to get rid of the __slots__
-    nuisance in the original class, whereupon you cannot
-    override instance methods.
+    Return path, or its closest ancestor that exists.
     """
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
 
 
-class GitBackend(object):
+class GitBackend(AsyncBackend):
     """
     Git backend for versioned file field's storage.
     See abcs.py for documentation.
     """
 
-    def __init__(self, fieldname):
-        location = getattr(settings, 'VFF_REPO_ROOT',
-                    os.path.join(settings.MEDIA_ROOT, 'vf_repo'))
+    def __init__(self, fieldname, location=None):
+        if location is None:
+            location = getattr(settings, 'VFF_REPO_ROOT',
+                        os.path.join(settings.MEDIA_ROOT, 'vf_repo'))
         self.location = os.path.abspath(location)
         self.sublocation = getattr(settings, 'VFF_REPO_PATH', '')
         self.fieldname = fieldname
-        try:
-            self.repo = Repo(self.location)
-        except (git.exc.NoSuchPathError, git.exc.InvalidGitRepositoryError):
-            self.repo = Repo.init(self.location)
+        # the repository is only opened on first use, and again in forked
+        # processes, see shared below
+        self._shared = None
+        # the pid of the process where it is ready, and where it is being
+        # set up
+        self._pid = None
+        self._setup_pid = None
+        # do not commit writes that leave a document as it was
+        self.skip_unchanged = getattr(settings, 'VFF_SKIP_UNCHANGED', True)
+        self.diff_engine = get_engine()
+
+    @property
+    def shared(self):
+        """
+        The SharedRepo of the repository, opening (or creating) it in this
+        process if that has not been done yet.
+        """
+        if self._pid != os.getpid():
+            with _setup_lock:
+                # while it is being set up, by this same thread, use it
+                if self._setup_pid != os.getpid():
+                    try:
+                        self._setup()
+                    except:
+                        self._setup_pid = None
+                        raise
+        return self._shared
+
+    @property
+    def repo(self):
+        return self.shared.repo
+
+    @property
+    def bare(self):
+        # bare repos have no working tree nor index, and we write
+        # blobs, trees and commits straight into the object database
+        return self.shared.repo.bare
+
+    @property
+    def commit_queue(self):
+        return self.shared.commit_queue
+
+    @property
+    def spool(self):
+        return self.shared.spool
+
+    def _setup(self):
+        """
+        Open the repository, creating it and the directory of the documents
+        (or the empty blob, if bare) if needed, and set up the revision
+        index, the group commit queue and the write behind spool, as
+        configured.
+        """
+        # all the backends on the same root share a single repo
+        self._shared = get_shared_repo(self.location,
+                                       getattr(settings, 'VFF_BARE_REPO',
+                                               False))
+        self._setup_pid = os.getpid()
         abs_sublocation = os.path.join(self.location, self.sublocation)
-        if not os.path.isdir(abs_sublocation):
-            os.makedirs(abs_sublocation)
-            readme = os.path.join(abs_sublocation, 'README')
-            f = open(readme, 'w')
-            f.write('VFF GIT REPOSITORY')
-            f.close()
-            self.repo.index.add([readme])
-            self.repo.index.commit('Initial vff commit')
+        with self.shared.lock:
+            index_path = getattr(settings, 'VFF_REVISION_INDEX', None)
+            if index_path and self.shared.revision_index is None:
+                if index_path is True:
+                    index_path = os.path.join(self.repo.git_dir,
+                                              'vff-revisions.sqlite')
+                self.shared.revision_index = RevisionIndex(index_path)
+            if self.bare:
+                # the blob that blob_hexsha gives for documents that are
+                # not in HEAD, for git diff to find it
+                write_blob(self.repo, BytesIO(), size=0)
+            if not self.bare and not os.path.isdir(abs_sublocation):
+                os.makedirs(abs_sublocation)
+                readme = os.path.join(abs_sublocation, 'README')
+                f = open(readme, 'w')
+                f.write('VFF GIT REPOSITORY')
+                f.close()
+                parent = self._head()
+                self.repo.index.add([readme])
+                vff = get_identity(u'vff')
+                commit = self.repo.index.commit('Initial vff commit',
+                                                author=vff, committer=vff)
+                self._record(parent, commit,
+                             [os.path.join(self.sublocation, 'README')])
+            if getattr(settings, 'VFF_GROUP_COMMIT', False):
+                if self.shared.commit_queue is None:
+                    self.shared.commit_queue = CommitQueue(
+                        self._commit_group,
+                        window=getattr(settings, 'VFF_GROUP_COMMIT_WINDOW',
+                                       0.05),
+                        batch_size=getattr(settings, 'VFF_GROUP_COMMIT_BATCH',
+                                           100))
+            spool_path = getattr(settings, 'VFF_WRITE_BEHIND', None)
+            if spool_path and self.shared.spool is None:
+                if spool_path is True:
+                    spool_path = os.path.join(self.repo.git_dir, 'vff-spool')
+                self.shared.spool = Spool(
+                    spool_path, self._commit_spooled,
+                    poll=getattr(settings, 'VFF_WRITE_BEHIND_POLL', 0.2),
+                    batch_size=getattr(settings, 'VFF_GROUP_COMMIT_BATCH',
+                                       100),
+                    max_attempts=getattr(settings,
+                                         'VFF_WRITE_BEHIND_ATTEMPTS', 5))
+        if self.spool is not None:
+            # commit what earlier processes may have left in the spool
+            self.spool.start()
+        self._pid = self._setup_pid
+
+    def check(self):
+        """
+        Return a list of the problems found with the repository, as
+        strings, without opening it, or creating it if it does not exist
+        yet, which is left to its first use.
+        """
+        if not os.path.exists(self.location):
+            parent = existing_parent(self.location)
+            if not os.access(parent, os.W_OK):
+                return ['Cannot create the vff repository at %s: %s is not'
+                        ' writable.' % (self.location, parent)]
+            return []
+        try:
+            repo = git.Repo(self.location)
+        except git.exc.InvalidGitRepositoryError:
+            # created in it on first use
+            if not os.access(self.location, os.W_OK):
+                return ['Cannot create the vff repository at %s: it is not'
+                        ' writable.' % self.location]
+            return []
+        except Exception as e:
+            return ['Cannot open the vff repository at %s: %s'
+                    % (self.location, e)]
+        problems = []
+        if not repo.bare:
+            path = existing_parent(os.path.join(self.location,
+                                                self.sublocation))
+            if not os.access(path, os.W_OK):
+                problems.append('The vff directory %s is not writable.'
+                                % path)
+        if not os.access(repo.git_dir, os.W_OK):
+            problems.append('The vff repository %s is not writable.'
+                            % repo.git_dir)
+        return problems
+
+    def get_executor(self, instance):
+        return get_executor(self.location)
 
     def get_filename(self, instance):
         class_name = instance.__class__.__name__.lower()
@@ -99,87 +264,800 @@ class GitBackend(object):
             return os.path.join(self.sublocation, name)
         return name
 
-    def _commit(self, fname, msg, username, action):
-        mu = USERPAT.match(username)
-        me = EMAILPAT.match(username)
-        if mu:
-            config = GITCONFIG % (mu.group(1), mu.group(2))
-        elif me:
-            config = GITCONFIG % (me.group(1), me.group(0))
+    def _head(self):
+        try:
+            return self.repo.head.commit.hexsha
+        except ValueError:
+            # no commits yet
+            return None
+
+    def _record(self, parent, commit, fnames):
+        """
+        Add the revisions made by commit to the revision index, if any.
+        """
+        index = self.shared.revision_index
+        if index is not None:
+            revisions = []
+            for fname in fnames:
+                author, message = commit_attribution(commit, fname)
+                revisions.append((fname, commit.hexsha, author, message,
+                                  commit.committed_date))
+            index.record(parent, commit.hexsha, revisions)
+
+    def _revision_index(self):
+        """
+        Return the revision index, brought up to date with the repository,
+        or None if there is no index or it cannot be brought up to date.
+        """
+        index = self.shared.revision_index
+        if index is None:
+            return None
+
+        def history(since):
+            try:
+                return list(history_revisions(self.repo, since))
+            except git.exc.GitCommandError:
+                # since is not in the history of HEAD any more
+                return None
+        with self.shared.lock:
+            if index.update(self._head(), history):
+                return index
+        return None
+
+    def rebuild_revision_index(self):
+        """
+        Rebuild the revision index from the history of the repository.
+        """
+        index = self.shared.revision_index
+        with self.shared.lock:
+            head = self._head()
+            revisions = head and history_revisions(self.repo) or []
+            index.rebuild(head, revisions)
+
+    def _commit(self, changes, msg, username, group=False):
+        """
+        Stage the changes, a list of (fname, binsha) tuples, and commit them
+        all together. binsha is the binary sha of the blob, already in the
+        object database, with the new content of the file, or None to
+        remove the file. Return the versionid of the new commit. Group
+        commits (group true) are committed by the group committer, and
+        other messages are escaped so that they cannot pass for them.
+        """
+        actor = get_identity(username)
+        if group:
+            committer = git.Actor(COMMITTER_NAME, COMMITTER_EMAIL)
         else:
-            config = GITCONFIG % (username, username)
-        with NamedTemporaryFile(delete=True) as f:
-            f.write(config.encode('utf8'))
-            f.seek(0)
-            def fun(self, config_level=None):
-                return f
-            meth = MethodType(fun, self.repo, Repo)
-            setattr(self.repo, '_get_config_path', meth)
-            setattr(self.repo, 'config_level', ['repository'])
-            clean_environment()
-            if action == 'add':
-                self.repo.index.add([fname])
-            elif action == 'delete':
-                full_path = os.path.join(self.location, fname)
-                if os.path.exists(full_path):
-                    self.repo.index.remove([fname], working_tree=True)
-            self.repo.index.commit(msg)
-
-    def add_revision(self, content, instance, commit_msg, username):
+            committer = actor
+            msg = escape_message(msg)
+        if self.bare:
+            return self._commit_tree(changes, msg, actor, committer)
+        with self.shared.lock:
+            parent = self._head()
+            index = self.repo.index
+            added = [BaseIndexEntry((FILEMODE, binsha, 0, fname))
+                     for fname, binsha in changes if binsha is not None]
+            deleted = [fname for fname, binsha in changes
+                       if binsha is None and
+                       os.path.exists(os.path.join(self.location, fname))]
+            try:
+                with measure('git.index', self):
+                    if added:
+                        index.add(added)
+                    if deleted:
+                        index.remove(deleted, working_tree=True)
+                with measure('git.commit', self):
+                    commit = index.commit(msg, author=actor,
+                                          committer=committer)
+            except:
+                self._unstage(changes)
+                raise
+            # still holding the lock, so that the working tree is that of
+            # HEAD for every commit
+            self._checkout(changes)
+            self._record(parent, commit,
+                         [entry.path for entry in added] + deleted)
+            return commit.hexsha
+
+    def _commit_tree(self, changes, msg, actor, committer):
+        """
+        Commit the changes, as in _commit, building the new trees straight
+        in the object database and moving HEAD to the new commit. Only the
+        trees along the changed paths are rewritten.
+        """
+        changes = dict(changes)
+        with self.shared.lock, measure('git.commit', self):
+            while True:
+                parent = self._head()
+                if parent is None:
+                    parents, tree = [], None
+                else:
+                    parents = [self.repo.commit(parent)]
+                    tree = parents[0].tree.binsha
+                tree, changed = update_tree(self.repo.odb, tree, changes,
+                                            FILEMODE)
+                commit = create_commit(self.repo, tree, msg, parents,
+                                       actor, committer)
+                try:
+                    # only move HEAD if nobody else did meanwhile
+                    self.repo.git.update_ref('-m', 'commit: vff', 'HEAD',
+                                             commit.hexsha,
+                                             parent or NULLSHA)
+                except git.exc.GitCommandError:
+                    if self._head() == parent:
+                        raise
+                    continue
+                self._record(parent, commit, changed)
+                return commit.hexsha
+
+    def _commit_group(self, batch):
+        if len(batch) == 1:
+            change = batch[0]
+            return self._commit([(change.fname, change.binsha)],
+                                change.commit_msg, change.username)
+        msg = format_group_message(batch,
+                                   lambda username: get_identity(username).name)
+        changes = [(change.fname, change.binsha) for change in batch]
+        return self._commit(changes, msg, batch[0].username, group=True)
+
+    def _submit(self, fname, binsha, commit_msg, username, callback):
+        if self.commit_queue is not None:
+            future = self.commit_queue.submit(fname, binsha,
+                                              commit_msg, username)
+            return self._add_callback(future, callback)
+        versionid = self._commit([(fname, binsha)], commit_msg, username)
+        if callback is not None:
+            callback(versionid)
+        return versionid
+
+    def _add_callback(self, future, callback):
+        if callback is not None:
+            def done(future):
+                if future.exception() is None:
+                    callback(future.result())
+            future.add_done_callback(done)
+        return future
+
+    def _commit_spooled(self, entries):
+        """
+        Commit a batch of writes from the write behind spool.
+        """
+        # writes whose commit may have been made before a crash are
+        # checked against HEAD, even if unchanged writes are not skipped
+        replay = any(entry.replay for entry in entries)
+        current = self._current_blobs([entry.fname for entry in entries],
+                                      force=replay)
+        changed = []
+        for entry in entries:
+            compare = self.skip_unchanged or entry.replay
+            blob = compare and current.get(entry.fname) or None
+            f = entry.open()
+            if f is None:
+                entry.binsha = None
+                if not entry.replay or entry.fname in current:
+                    changed.append(entry)
+                continue
+            with f:
+                entry.binsha = self._write_revision(File(f), entry.fname,
+                                                    blob)
+            if entry.binsha != blob:
+                changed.append(entry)
+        if len(changed) < len(entries):
+            self._count_skipped(len(entries) - len(changed))
+        if changed:
+            return self._commit_group(changed)
+        if len(entries) == 1:
+            return self._existing(entries[0].fname)
+        # a commit with the current content of all of them
+        with self.shared.lock:
+            return self._head()
+
+    def add_revision(self, content, instance, commit_msg, username,
+                     callback=None):
         fname = self.get_filename(instance)
+        if self.spool is not None:
+            future = self.spool.submit(fname, content, commit_msg, username)
+            return self._add_callback(future, callback)
+        if self.commit_queue is not None:
+            self.commit_queue.wait_for(fname)
+        current = self._current_blobs([fname]).get(fname)
+        binsha = self._write_revision(content, fname, current)
+        if binsha == current:
+            self._count_skipped(1)
+            versionid = self._existing(fname)
+            if callback is not None:
+                callback(versionid)
+            return versionid
+        return self._submit(fname, binsha, commit_msg, username, callback)
+
+    def bulk_add_revisions(self, revisions, commit_msg, username,
+                           callback=None):
+        # the last content of each document
+        revisions = dict((self.get_filename(instance), content)
+                         for instance, content in revisions).items()
+        if not revisions:
+            return None
+        if self.spool is not None:
+            # do not let older spooled writes overwrite these
+            self.spool.drain(wait=True)
+        for fname, content in revisions:
+            if self.commit_queue is not None:
+                self.commit_queue.wait_for(fname)
+        current = self._current_blobs([fname for fname, content in revisions])
+        changes = {}
+        for fname, content in revisions:
+            binsha = self._write_revision(content, fname, current.get(fname))
+            if binsha != current.get(fname):
+                changes[fname] = binsha
+        if len(changes) < len(revisions):
+            self._count_skipped(len(revisions) - len(changes))
+        if not changes:
+            # a commit with the current content of all of them
+            with self.shared.lock:
+                versionid = self._head()
+            if callback is not None:
+                callback(versionid)
+            return versionid
+        return self._commit_bulk(changes, commit_msg, username, callback)
+
+    def _current_blobs(self, fnames, force=False):
+        """
+        Return a dictionary mapping those of fnames that are in the last
+        commit to the binary shas of their blobs there, to tell unchanged
+        writes; an empty one if those are not to be skipped, unless force
+        is true.
+        """
+        if not self.skip_unchanged and not force:
+            return {}
+        with self.shared.lock:
+            head = self._head()
+            if head is None:
+                return {}
+            tree = self.repo.commit(head).tree.binsha
+            return find_blobs(self.repo.odb, tree, fnames)
+
+    def _count_skipped(self, count):
+        with self.shared.lock:
+            self.shared.skipped_writes += count
+
+    def _existing(self, fname):
+        """
+        Return the versionid of the latest revision of fname, for writes
+        that leave it unchanged.
+        """
+        revs = self._list_revisions(fname, 1, 0)
+        return revs and revs[0]['versionid'] or None
+
+    @timed('git.write')
+    def _write_revision(self, content, fname, current=None):
+        """
+        Write content as the new revision of fname, to the object database
+        and, unless the repository is bare, to a file next to its working
+        copy, that replaces it when the revision is committed (see
+        _checkout). Return the binary sha of its blob. If that is current,
+        the binary sha of the blob of fname in the last commit, the working
+        tree is left alone.
+        """
         full_path = os.path.join(self.location, fname)
-        if hasattr(content, 'temporary_file_path'):
+        permissions = settings.FILE_UPLOAD_PERMISSIONS
+        size = content_size(content)
+        if self.bare:
+            return self._store_content(content, size)
+        elif hasattr(content, 'temporary_file_path'):
+            binsha = None
+            if current is not None:
+                binsha = store_file(self.repo, content.temporary_file_path())
+                if binsha == current:
+                    content.close()
+                    return binsha
             # This file has a file path that we can move.
-            file_move_safe(content.temporary_file_path(), full_path)
+            staged = self._staging_path(full_path)
+            file_move_safe(content.temporary_file_path(), staged,
+                           allow_overwrite=True)
             content.close()
+            binsha = binsha or store_file(self.repo, staged)
+            return self._stage(fname, binsha, staged, permissions)
+        elif size is not None:
+            # Stream the content in chunks both to the working tree and
+            # to the object database, hashing it on the way.
+            writer = write_blob(self.repo, content, full_path, size)
+            if writer.binsha == current:
+                writer.discard()
+                return writer.binsha
+            return self._stage(fname, writer.binsha, writer.detach(),
+                               permissions)
         else:
-            # This is a normal uploadedfile that we can stream.
-            with open(full_path, 'w') as f:
-                content.seek(0)
-                f.write(content.read())
-        if settings.FILE_UPLOAD_PERMISSIONS is not None:
-            os.chmod(full_path, settings.FILE_UPLOAD_PERMISSIONS)
-        self._commit(fname, commit_msg, username, 'add')
-
-    def del_document(self, instance, commit_msg, username):
+            # We cannot know the size of the blob beforehand.
+            staged = self._staging_path(full_path)
+            with open(staged, 'wb') as f:
+                for chunk in iter_chunks(content):
+                    f.write(chunk)
+            return self._stage(fname, store_file(self.repo, staged), staged,
+                               permissions)
+
+    def _staging_path(self, full_path):
+        """
+        Return the name of a new empty file next to full_path.
+        """
+        fd, path = mkstemp(dir=os.path.dirname(full_path),
+                           prefix='.vff-tmp-')
+        os.close(fd)
+        return path
+
+    def _stage(self, fname, binsha, path, permissions=None):
+        """
+        Keep path, a file with the content of the blob binsha, as the
+        working copy of fname once binsha is committed as fname. Return
+        binsha.
+        """
+        if permissions is not None:
+            os.chmod(path, permissions)
+        with self.shared.lock:
+            if (fname, binsha) not in self.shared.staged:
+                self.shared.staged[(fname, binsha)] = path
+                return binsha
+        # the same content is staged already
+        os.unlink(path)
+        return binsha
+
+    def _unstage(self, changes):
+        """
+        Remove the files staged for changes, that failed to commit.
+        """
+        for fname, binsha in changes:
+            path = self.shared.staged.pop((fname, binsha), None)
+            if path is not None and os.path.exists(path):
+                os.unlink(path)
+
+    def _checkout(self, changes):
+        """
+        Replace the working copies of the files written in changes, just
+        committed, with their staged files. Must be called holding the
+        lock.
+        """
+        for fname, binsha in changes:
+            if binsha is None:
+                # removed with the index
+                continue
+            full_path = os.path.join(self.location, fname)
+            staged = self.shared.staged.pop((fname, binsha), None)
+            if staged is None:
+                # the same content was staged by another write, and was
+                # checked out when that one was committed
+                staged = self._staging_path(full_path)
+                with open(staged, 'wb') as f:
+                    for chunk in iter_chunks(self.repo.odb.stream(binsha)):
+                        f.write(chunk)
+                permissions = settings.FILE_UPLOAD_PERMISSIONS
+                if permissions is not None:
+                    os.chmod(staged, permissions)
+            os.rename(staged, full_path)
+
+    def _store_content(self, content, size):
+        """
+        Store content as a blob in the object database, with no working
+        tree copy, and return its binary sha.
+        """
+        if hasattr(content, 'temporary_file_path'):
+            binsha = store_file(self.repo, content.temporary_file_path())
+            content.close()
+            return binsha
+        if size is not None:
+            return write_blob(self.repo, content, size=size).binsha
+        # We cannot know the size of the blob beforehand.
+        with TemporaryFile() as f:
+            for chunk in iter_chunks(content):
+                f.write(chunk)
+            size = f.tell()
+            f.seek(0)
+            return write_blob(self.repo, f, size=size).binsha
+
+    def del_document(self, instance, commit_msg, username, callback=None):
         fname = self.get_filename(instance)
-        self._commit(fname, commit_msg, username, 'delete')
+        if self.spool is not None:
+            future = self.spool.submit(fname, None, commit_msg, username)
+            return self._add_callback(future, callback)
+        if self.commit_queue is not None:
+            self.commit_queue.wait_for(fname)
+        return self._submit(fname, None, commit_msg, username, callback)
+
+    def bulk_del_documents(self, instances, commit_msg, username,
+                           callback=None):
+        changes = {}
+        for instance in instances:
+            fname = self.get_filename(instance)
+            if self.commit_queue is not None:
+                self.commit_queue.wait_for(fname)
+            changes[fname] = None
+        return self._commit_bulk(changes, commit_msg, username, callback)
+
+    def _commit_bulk(self, changes, commit_msg, username, callback):
+        """
+        Commit changes, a dictionary mapping fnames to binary shas as in
+        _commit, right away, bypassing the group commit queue and the write
+        behind spool.
+        """
+        if not changes:
+            return None
+        if self.spool is not None:
+            # do not let older spooled writes overwrite these
+            self.spool.drain(wait=True)
+        versionid = self._commit(changes.items(), commit_msg, username)
+        if callback is not None:
+            callback(versionid)
+        return versionid
 
-    def list_revisions(self, instance, count=0, offset=0):
+    def list_revisions(self, instance, count=0, offset=0, after=None):
         fname = self.get_filename(instance)
+        # (cursor, revision) tuples of the writes still in the spool, that
+        # go first
+        pending = []
+        if self.spool is not None:
+            pending = [(PENDING + entry.id, self._pending_revision(entry))
+                       for entry in reversed(self.spool.entries(fname))]
+        if after is not None and after.startswith(PENDING):
+            pending = [p for p in pending if p[0] < after]
+            after = None
+        elif after is not None:
+            pending = []
+        if count < 0:
+            # all of them
+            count = 0
+        # one more than count, to tell whether there is a next page
+        limit = count and count + 1
+        page = pending[offset:limit and offset + limit or None]
+        offset = max(offset - len(pending), 0)
+        if not limit or len(page) < limit:
+            committed = self._list_revisions(fname,
+                                             limit and limit - len(page),
+                                             offset, after)
+            page.extend((rev['versionid'], rev) for rev in committed)
+        cursor = None
+        if count and len(page) > count:
+            page = page[:count]
+            cursor = page[-1][0]
+        return RevisionPage([rev for position, rev in page], cursor)
+
+    def count_revisions(self, instance):
+        fname = self.get_filename(instance)
+        count = 0
+        if self.spool is not None:
+            count = len(self.spool.entries(fname))
+        index = self._revision_index()
+        if index is not None:
+            return count + index.count(fname)
+        with self.shared.lock:
+            if self._head() is None:
+                return count
+            with measure('git.history', self):
+                return count + int(self.repo.git.rev_list('--count', 'HEAD',
+                                                          '--', fname))
+
+    def _pending_revision(self, entry):
+        """
+        Return a revision, as in list_revisions, for a spooled write, with
+        no versionid (yet) and a true 'pending' key.
+        """
+        return {'versionid': None,
+                'author': get_identity(entry.username).name,
+                'message': entry.commit_msg,
+                'date': datetime.datetime.fromtimestamp(entry.time),
+                'pending': True}
+
+    def _spooled(self, fname):
+        """
+        Return an open binary file with the content of the latest spooled
+        write of fname, an empty one for a removal, or None if there is no
+        spooled write of fname.
+        """
+        entry = self.spool.latest(fname)
+        if entry is None:
+            return None
+        try:
+            return entry.open() or BytesIO()
+        except IOError:
+            # committed meanwhile
+            return None
+
+    def _list_revisions(self, fname, count, offset, after=None):
+        index = self._revision_index()
+        if index is not None:
+            return index.list(fname, count=count, offset=offset, after=after)
         revs = []
         kwargs = {}
         if count:
-            kwargs['count'] = count
+            kwargs['max_count'] = count
         if offset:
-            kwargs['offset'] = offset
-        for ci in self.repo.iter_commits(paths=fname, **kwargs):
-            rev = {'versionid': ci.hexsha,
-                   'author': ci.author.name,
-                   'message': ci.message,
-                   'date': datetime.datetime.fromtimestamp(ci.committed_date),}
-            revs.append(rev)
+            kwargs['skip'] = offset
+        with self.shared.lock:
+            if self._head() is None:
+                return revs
+            rev = None
+            if after is not None:
+                if not HEXSHA.match(after):
+                    raise ValueError('%s has no revision %s' % (fname, after))
+                # the history of fname before after
+                rev = '%s^@' % after
+            try:
+                with measure('git.history', self):
+                    for ci in self.repo.iter_commits(rev, paths=fname,
+                                                     **kwargs):
+                        revs.append(self._revision(ci, fname))
+            except git.exc.GitCommandError:
+                if after is None:
+                    raise
+                raise ValueError('%s has no revision %s' % (fname, after))
         return revs
 
+    def _revision(self, commit, fname):
+        author, message = commit_attribution(commit, fname)
+        return {'versionid': commit.hexsha,
+                'author': author,
+                'message': message,
+                'date': datetime.datetime.fromtimestamp(commit.committed_date),}
+
+    def _resolve(self, rev):
+        """
+        Return the full id of the commit that rev refers to.
+        """
+        if FULLSHA.match(rev):
+            return rev
+        with self.shared.lock:
+            return self.repo.commit(rev).hexsha
+
+    def _latest(self, fname):
+        """
+        Return the id of the last commit, if it has fname, for bare repos,
+        where there is no working tree to read the latest revision from.
+        """
+        with self.shared.lock:
+            head = self._head()
+            if head is not None:
+                try:
+                    self.repo.commit(head).tree[fname]
+                except KeyError:
+                    return None
+            return head
+
     def get_revision(self, instance, rev=None):
         fname = self.get_filename(instance)
+        if not rev and self.spool is not None:
+            f = self._spooled(fname)
+            if f is not None:
+                with f:
+                    return f.read().decode('utf8')
+        if not rev and self.bare:
+            rev = self._latest(fname)
+        if rev:
+            cache = self.shared.cache
+            key = ('revision', self._resolve(rev), fname)
+            if cache is not None:
+                cached = cache.get(key)
+                if cached is not None:
+                    return cached
+            with self.shared.lock:
+                blob = self.repo.commit(key[1]).tree[fname]
+                text = blob.data_stream[3].read().decode('utf8')
+            if cache is not None:
+                cache.set(key, text)
+            return text
+        elif not self.bare:
+            return self._read_working_copy(fname)
+        return u''
+
+    def open_revision(self, instance, rev=None):
+        fname = self.get_filename(instance)
+        if not rev and self.spool is not None:
+            f = self._spooled(fname)
+            if f is not None:
+                return f
         full_path = os.path.join(self.location, fname)
-        text = u''
+        if not rev and self.bare:
+            rev = self._latest(fname)
         if rev:
-            blob = self.repo.commit(rev).tree[fname]
-            text = blob.data_stream[3].read()
-        elif os.path.exists(full_path):
+            with self.shared.lock:
+                blob = self.repo.commit(rev).tree[fname]
+                return BlobReader(self.repo, blob.hexsha)
+        elif not self.bare and os.path.exists(full_path):
+            return open(full_path, 'rb')
+        return BytesIO()
+
+    def prefetch_revisions(self, instances, rev=None, metadata=True):
+        fnames = dict((instance.pk, self.get_filename(instance))
+                      for instance in instances)
+        wanted = set(fnames.values())
+        contents = self._prefetch_contents(wanted, rev)
+        latest = {}
+        if metadata:
+            latest = self._prefetch_latest(wanted)
+        if self.spool is not None:
+            # writes still in the spool go first
+            for entry in self.spool.entries():
+                if entry.fname not in wanted:
+                    continue
+                if not rev:
+                    try:
+                        f = entry.open() or BytesIO()
+                    except IOError:
+                        # committed meanwhile
+                        continue
+                    with f:
+                        contents[entry.fname] = f.read().decode('utf8')
+                if metadata:
+                    latest[entry.fname] = self._pending_revision(entry)
+        return dict((pk, (contents.get(fname), latest.get(fname)))
+                    for pk, fname in fnames.items())
+
+    def _prefetch_contents(self, fnames, rev):
+        """
+        Return a dictionary mapping each of fnames to its content in the
+        revision rev, as get_revision would, reading all the blobs that
+        are not in the cache from a single git process. Files that are
+        not in rev are left out.
+        """
+        contents = {}
+        if not rev and not self.bare:
+            for fname in fnames:
+                contents[fname] = self._read_working_copy(fname)
+            return contents
+        missing = None
+        if not rev:
+            # as in get_revision, the latest revision of a document
+            # that is not in HEAD is empty
+            missing = u''
+            with self.shared.lock:
+                rev = self._head()
+            if rev is None:
+                return dict((fname, missing) for fname in fnames)
+        else:
+            rev = self._resolve(rev)
+        cache = self.shared.cache
+        wanted = []
+        for fname in fnames:
+            cached = None
+            if cache is not None:
+                cached = cache.get(('revision', rev, fname))
+            if cached is None:
+                wanted.append(fname)
+            else:
+                contents[fname] = cached
+        if wanted:
+            with self.shared.lock:
+                blobs = find_blobs(self.repo.odb,
+                                   self.repo.commit(rev).tree.binsha, wanted)
+            paths = {}
+            for fname, binsha in blobs.items():
+                paths.setdefault(bin_to_hex(binsha), []).append(fname)
+            for hexsha, data in read_blobs(self.repo, paths):
+                text = data.decode('utf8')
+                for fname in paths[hexsha]:
+                    contents[fname] = text
+                    if cache is not None:
+                        cache.set(('revision', rev, fname), text)
+        if missing is not None:
+            for fname in fnames:
+                contents.setdefault(fname, missing)
+        return contents
+
+    def _prefetch_latest(self, fnames):
+        """
+        Return a dictionary mapping each of fnames that has revisions to
+        the latest of them, as listed by list_revisions.
+        """
+        index = self._revision_index()
+        if index is not None:
+            latest = dict((fname, index.latest(fname)) for fname in fnames)
+            return dict((fname, rev) for fname, rev in latest.items() if rev)
+        with self.shared.lock:
+            return dict((fname, self._revision(commit, fname))
+                        for fname, commit in
+                        last_changes(self.repo, fnames).items())
+
+    def latest_metadata(self, instances):
+        instances = list(instances)
+        fnames = dict((instance.pk, self.get_filename(instance))
+                      for instance in instances)
+        pending = set()
+        if self.spool is not None:
+            pending = set(entry.fname for entry in self.spool.entries())
+        wanted = set(fnames.values()) - pending
+        latest = self._prefetch_latest(wanted)
+        index = self._revision_index()
+        counts = {}
+        if index is not None:
+            counts = dict((fname, index.count(fname)) for fname in wanted)
+        sizes = {}
+        with self.shared.lock:
+            head = self._head()
+            if head is not None and index is None:
+                with measure('git.history', self):
+                    counts = change_counts(self.repo, wanted)
+            if head is not None and self.bare:
+                tree = self.repo.commit(head).tree
+                for fname in wanted:
+                    try:
+                        sizes[fname] = tree[fname].size
+                    except KeyError:
+                        # removed
+                        pass
+        if not self.bare:
+            for fname in wanted:
+                path = os.path.join(self.location, fname)
+                if os.path.exists(path):
+                    sizes[fname] = os.path.getsize(path)
+        metadata = {}
+        for instance in instances:
+            fname = fnames[instance.pk]
+            if fname in pending:
+                # with the writes still in the spool
+                revs = self.list_revisions(instance, count=1)
+                metadata[instance.pk] = (revs and revs[0] or None,
+                                         self.get_size(fname),
+                                         self.count_revisions(instance))
+            else:
+                metadata[instance.pk] = (latest.get(fname), sizes.get(fname),
+                                         counts.get(fname, 0))
+        return metadata
+
+    def _read_working_copy(self, fname):
+        """
+        Return the content of the working copy of fname, or an empty
+        string if there is none.
+        """
+        full_path = os.path.join(self.location, fname)
+        text = ''
+        if os.path.exists(full_path):
             with open(full_path) as f:
                 text = f.read()
         return text.decode('utf8')
-    
-    def get_diff(self, instance, r1, r2):
-        md1 = self.get_revision(instance, r1).split(u'\n')
-        md2 = self.get_revision(instance, r2).split(u'\n')
-        diff = u'\n'.join(difflib.unified_diff(md1, md2,
-                                              fromfile=r1,
-                                              tofile=r2,
-                                              ))
+
+    def get_size(self, fname, rev=None):
+        """
+        Return the size of the file fname in the given revision, or in the
+        latest one if rev is None.
+        """
+        if not rev and self.spool is not None:
+            f = self._spooled(fname)
+            if f is not None:
+                with f:
+                    f.seek(0, os.SEEK_END)
+                    return f.tell()
+        if not rev and not self.bare:
+            return os.path.getsize(os.path.join(self.location, fname))
+        with self.shared.lock:
+            return self.repo.commit(rev or 'HEAD').tree[fname].size
+
+    def blob_hexsha(self, fname, rev=None):
+        """
+        Return the id of the blob of fname in the revision rev, or None for
+        the working copy (rev None) in non bare repositories, or if there
+        are spooled writes of fname.
+        """
+        if not rev:
+            if not self.bare:
+                return None
+            if self.spool is not None and self.spool.latest(fname):
+                return None
+            rev = self._latest(fname)
+            if rev is None:
+                # stored when the repository is set up
+                return EMPTY_BLOB
+        with self.shared.lock:
+            return self.repo.commit(rev).tree[fname].hexsha
+
+    def get_diff(self, instance, r1, r2, **options):
+        cache = self.shared.cache
+        key = None
+        if cache is not None and r1 and r2:
+            key = ('diff', self.get_filename(instance),
+                   self._resolve(r1), self._resolve(r2), r1, r2)
+            key += tuple(u'%s=%s' % item for item in sorted(options.items()))
+            cached = cache.get(key)
+            if cached is not None:
+                # structured diffs are lists, that callers may change
+                return copy.deepcopy(cached)
+        diff = self.diff_engine.diff(self, instance, r1, r2, **options)
+        if key is not None:
+            cache.set(key, copy.deepcopy(diff))
         return diff
 
 VFFBackend.register(GitBackend)
@@ -0,0 +1,165 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import time
+from io import BytesIO
+
+from gitdb import IStream
+from git.objects import Commit, Tree
+from git.objects.fun import tree_entries_from_data, tree_to_stream
+
+TREEMODE = 0o40000
+
+
+def read_tree(odb, binsha):
+    """
+    Return the entries, (binsha, mode, name) tuples, of a tree. A binsha
+    of None stands for the empty tree.
+    """
+    if binsha is None:
+        return []
+    return tree_entries_from_data(odb.stream(binsha).read())
+
+
+def write_tree(odb, entries):
+    """
+    Store a tree with the given (binsha, mode, name) entries, and return
+    its binary sha.
+    """
+    # git sorts directories as if their names ended with a slash
+    entries = sorted(entries, key=lambda e: e[2] + (e[1] == TREEMODE
+                                                    and '/' or ''))
+    stream = BytesIO()
+    tree_to_stream(entries, stream.write)
+    size = stream.tell()
+    stream.seek(0)
+    return odb.store(IStream(Tree.type, size, stream)).binsha
+
+
+def update_tree(odb, binsha, changes, mode):
+    """
+    Apply changes to the tree binsha, and return the binary sha of the
+    new tree (None if it ends up empty) and the list of paths that were
+    actually changed.
+
+    changes is a dictionary mapping paths, relative to the tree, to the
+    binary sha of a blob, to be added with mode, or to None, to remove the
+    path. Only the trees along the changed paths are read and rewritten.
+    """
+    entries = dict((name, (sha, m)) for sha, m, name in read_tree(odb, binsha))
+    subchanges = {}
+    changed = []
+    for path, blob in changes.items():
+        if '/' in path:
+            head, rest = path.split('/', 1)
+            subchanges.setdefault(head, {})[rest] = blob
+        elif blob is None:
+            if entries.pop(path, None) is not None:
+                changed.append(path)
+        elif entries.get(path) != (blob, mode):
+            entries[path] = (blob, mode)
+            changed.append(path)
+    for name, sub in subchanges.items():
+        old = entries.get(name)
+        subtree = old is not None and old[1] == TREEMODE and old[0] or None
+        new, subchanged = update_tree(odb, subtree, sub, mode)
+        if new is None:
+            entries.pop(name, None)
+        else:
+            entries[name] = (new, TREEMODE)
+        changed.extend('%s/%s' % (name, path) for path in subchanged)
+    if not changed:
+        return binsha, changed
+    if not entries:
+        return None, changed
+    return write_tree(odb, [(sha, m, name)
+                            for name, (sha, m) in entries.items()]), changed
+
+
+def find_blobs(odb, binsha, paths):
+    """
+    Return a dictionary mapping those of the given paths, relative to the
+    tree binsha, that are blobs in it to their binary shas. Each tree is
+    read at most once, however many paths there are in it.
+    """
+    entries = dict((name, (sha, m)) for sha, m, name in read_tree(odb, binsha))
+    found = {}
+    subpaths = {}
+    for path in paths:
+        if '/' in path:
+            head, rest = path.split('/', 1)
+            subpaths.setdefault(head, []).append(rest)
+        elif path in entries and entries[path][1] != TREEMODE:
+            found[path] = entries[path][0]
+    for name, sub in subpaths.items():
+        entry = entries.get(name)
+        if entry is not None and entry[1] == TREEMODE:
+            for path, blob in find_blobs(odb, entry[0], sub).items():
+                found['%s/%s' % (name, path)] = blob
+    return found
+
+
+def empty_tree(odb):
+    return write_tree(odb, [])
+
+
+def create_commit(repo, tree, message, parents, author, committer,
+                  authored_date=None, author_tz_offset=None,
+                  committed_date=None, committer_tz_offset=None):
+    """
+    Store a commit of the tree with binary sha tree, and return it. Unlike
+    Commit.create_from_tree, do not look at the git configuration or at
+    the environment, nor update any reference.
+
+    params:
+    - parents: a list of the parent Commits
+    - author, committer: git.Actor instances
+    - dates are unix timestamps, and tz offsets seconds west of UTC, as in
+      git.Commit; they default to now and to the local timezone.
+    """
+    now = int(time.time())
+    if time.daylight and time.localtime(now).tm_isdst:
+        offset = time.altzone
+    else:
+        offset = time.timezone
+    if authored_date is None:
+        authored_date, author_tz_offset = now, offset
+    if committed_date is None:
+        committed_date, committer_tz_offset = now, offset
+    if tree is None:
+        tree = empty_tree(repo.odb)
+    commit = Commit(repo, Commit.NULL_BIN_SHA, Tree(repo, tree),
+                    author, authored_date, author_tz_offset,
+                    committer, committed_date, committer_tz_offset,
+                    message, parents, Commit.default_encoding)
+    stream = BytesIO()
+    commit._serialize(stream)
+    size = stream.tell()
+    stream.seek(0)
+    commit.binsha = repo.odb.store(IStream(Commit.type, size, stream)).binsha
+    return commit
@@ -0,0 +1,337 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import os
+import atexit
+import threading
+
+import git
+from git.db import GitDB
+from gitdb.exc import BadObject
+
+from vff.cache import RevisionCache
+from vff.executor import forget_executors, shutdown_executors
+from vff.group_commit import (COMMITTER_EMAIL, COMMITTER_NAME,
+                               parse_group_message)
+from vff.instrumentation import count_git_calls
+
+# beyond this many paths, git log is not given them but the whole history
+# is filtered here, so that the command line does not grow too long
+MAX_PATH_ARGS = 1000
+
+
+class RefreshingGitDB(GitDB):
+    """
+    Object database that looks again at the packs of the repository when
+    an object is missing, since loose objects may have been packed (e.g.
+    by vff.maintenance) since it last looked.
+    """
+
+    def _retry(self, method, *args):
+        try:
+            return method(self, *args)
+        except BadObject:
+            self.update_cache(force=True)
+            return method(self, *args)
+
+    def info(self, sha):
+        return self._retry(GitDB.info, sha)
+
+    def stream(self, sha):
+        return self._retry(GitDB.stream, sha)
+
+    def partial_to_complete_sha_hex(self, partial_hexsha):
+        return self._retry(GitDB.partial_to_complete_sha_hex, partial_hexsha)
+
+
+class SharedRepo(object):
+    """
+    A git repository shared by all the backends that work on the same root.
+
+    GitPython objects are not thread safe, so every access to ``repo``
+    (and to the persistent ``git cat-file`` helpers it keeps open) has to
+    be done holding ``lock``.
+    """
+
+    def __init__(self, location, bare=False):
+        self.location = location
+        self.lock = threading.RLock()
+        # contents of revisions and diffs, keyed by commit id
+        self.cache = RevisionCache.from_settings()
+        # set by the backends when group commits are enabled
+        self.commit_queue = None
+        # set by the backends when write behind is enabled
+        self.spool = None
+        # set by the backends when the revision index is enabled
+        self.revision_index = None
+        # writes not committed because they left their document unchanged
+        self.skipped_writes = 0
+        # working tree copies of the written revisions that are not
+        # committed yet, keyed by (fname, binsha), see GitBackend._stage
+        self.staged = {}
+        try:
+            self.repo = git.Repo(location, odbt=RefreshingGitDB)
+        except (git.exc.NoSuchPathError, git.exc.InvalidGitRepositoryError):
+            git.Repo.init(location, bare=bare)
+            self.repo = git.Repo(location, odbt=RefreshingGitDB)
+        count_git_calls(self.repo)
+
+    def helper_processes(self):
+        """
+        Return the pids of the persistent git helper processes that are
+        currently alive for this repository.
+        """
+        pids = []
+        for attr in ('cat_file_all', 'cat_file_header'):
+            cmd = getattr(self.repo.git, attr, None)
+            proc = getattr(cmd, 'proc', None)
+            if proc is not None and proc.poll() is None:
+                pids.append(proc.pid)
+        return pids
+
+    def forget(self):
+        """
+        Drop the persistent git helper processes without terminating them,
+        for forked processes, where they belong to the parent.
+        """
+        for attr in ('cat_file_all', 'cat_file_header'):
+            cmd = getattr(self.repo.git, attr, None)
+            if cmd is not None:
+                # or else it kills the process when it goes away
+                cmd.proc = None
+        self.repo.git.clear_cache()
+
+    def close(self):
+        """
+        Commit any queued or spooled writes and terminate the persistent
+        git helper processes. They will be started again on demand.
+        """
+        if self.commit_queue is not None:
+            self.commit_queue.close()
+        if self.spool is not None:
+            self.spool.close()
+        with self.lock:
+            self.repo.git.clear_cache()
+
+
+def commit_attribution(commit, fname):
+    """
+    Return the (author, message) tuple that corresponds to the change to
+    fname made in commit, taking into account group commits. Only the
+    trailers of commits made by the group committer are trusted.
+    """
+    committer = commit.committer
+    if committer.name == COMMITTER_NAME and \
+            committer.email == COMMITTER_EMAIL:
+        return parse_group_message(commit.message).get(
+            fname, (commit.author.name, commit.message))
+    return commit.author.name, commit.message
+
+
+def iter_history(repo, since=None):
+    """
+    Iterate, in chronological order, over the commits reachable from HEAD
+    (and not from since, if given), yielding a (commit, paths) tuple for
+    each, with paths the list of files changed in the commit.
+    """
+    args = ['--reverse', '--format=%x00%H', '--name-only', '--no-renames']
+    if since is None:
+        args.append('HEAD')
+    else:
+        args.append('%s..HEAD' % since)
+    for chunk in repo.git.log(*args).split('\x00'):
+        lines = [line for line in chunk.splitlines() if line]
+        if lines:
+            yield repo.commit(lines[0]), lines[1:]
+
+
+def history_revisions(repo, since=None):
+    """
+    Iterate over the history of repo as iter_history, yielding a
+    (fname, versionid, author, message, date) tuple for each file changed
+    in each commit, as needed by vff.revision_index.
+    """
+    for commit, paths in iter_history(repo, since):
+        for fname in paths:
+            author, message = commit_attribution(commit, fname)
+            yield (fname, commit.hexsha, author, message,
+                   commit.committed_date)
+
+
+def last_changes(repo, fnames):
+    """
+    Return a dictionary mapping those of fnames that appear in the history
+    of HEAD to the last commit that changed them, walking the history only
+    once, and only as far back as needed.
+    """
+    fnames = set(fnames)
+    found = {}
+    if not fnames:
+        return found
+    args = ['--format=%x00%H', '--name-only', '--no-renames', 'HEAD']
+    if len(fnames) <= MAX_PATH_ARGS:
+        args.append('--')
+        args.extend(sorted(fnames))
+    cmd = repo.git.log(*args, as_process=True)
+    proc = cmd.proc
+    try:
+        sha = None
+        for line in proc.stdout:
+            line = line.strip()
+            if line.startswith('\x00'):
+                sha = line[1:]
+            elif line in fnames and line not in found:
+                found[line] = sha
+                if len(found) == len(fnames):
+                    break
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        cmd.proc = None
+        proc.stdout.close()
+        proc.stderr.close()
+    return dict((fname, repo.commit(sha)) for fname, sha in found.items())
+
+
+def change_counts(repo, fnames):
+    """
+    Return a dictionary mapping each of fnames to the number of commits in
+    the history of HEAD that changed it, walking the history only once.
+    """
+    fnames = set(fnames)
+    counts = dict((fname, 0) for fname in fnames)
+    if not fnames:
+        return counts
+    args = ['--format=', '--name-only', '--no-renames', 'HEAD']
+    if len(fnames) <= MAX_PATH_ARGS:
+        args.append('--')
+        args.extend(sorted(fnames))
+    cmd = repo.git.log(*args, as_process=True)
+    proc = cmd.proc
+    try:
+        for line in proc.stdout:
+            line = line.strip()
+            if line in counts:
+                counts[line] += 1
+    finally:
+        proc.wait()
+        cmd.proc = None
+        proc.stdout.close()
+        proc.stderr.close()
+    return counts
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+_registry_pid = os.getpid()
+
+
+def _after_fork():
+    """
+    Forget, in a forked process, the repositories opened by its parent:
+    their helper processes, threads and locks belong to the parent, so the
+    child opens the repositories again on first use.
+    """
+    global _registry_lock, _registry_pid
+    _registry_lock = threading.Lock()
+    _registry_pid = os.getpid()
+    shared_repos = list(_registry.values())
+    _registry.clear()
+    for shared in shared_repos:
+        shared.forget()
+    forget_executors()
+
+
+def _check_fork():
+    # for pythons without os.register_at_fork
+    if _registry_pid != os.getpid():
+        _after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def get_shared_repo(location, bare=False):
+    """
+    Return the SharedRepo for the repository at location, opening (or
+    initializing, as a bare repository if bare is true) it the first time
+    it is asked for in this process.
+    """
+    location = os.path.abspath(location)
+    _check_fork()
+    with _registry_lock:
+        shared = _registry.get(location)
+        if shared is None:
+            shared = _registry[location] = SharedRepo(location, bare)
+    return shared
+
+
+def release_repos():
+    """
+    Close all the shared repositories and empty the registry, once the
+    calls of the async API are done.
+    """
+    shutdown_executors()
+    _check_fork()
+    with _registry_lock:
+        shared_repos = list(_registry.values())
+        _registry.clear()
+    for shared in shared_repos:
+        shared.close()
+
+
+def repo_stats():
+    """
+    Return a dictionary with a key per repository root opened in this
+    process, each with a dictionary with the pids of its live git helper
+    processes, the counters of its revision cache, the depth and lag of its
+    write behind spool and the number of writes skipped because they left
+    their document unchanged, and a 'subprocesses' key with the total number
+    of helpers.
+    """
+    stats = {'pid': os.getpid(), 'repos': {}, 'subprocesses': 0}
+    _check_fork()
+    with _registry_lock:
+        shared_repos = list(_registry.values())
+    for shared in shared_repos:
+        pids = shared.helper_processes()
+        stats['repos'][shared.location] = {
+            'helper_pids': pids,
+            'skipped_writes': shared.skipped_writes,
+        }
+        if shared.cache is not None:
+            stats['repos'][shared.location]['cache'] = shared.cache.stats()
+        if shared.spool is not None:
+            stats['repos'][shared.location]['spool'] = shared.spool.stats()
+        stats['subprocesses'] += len(pids)
+    return stats
+
+
+atexit.register(release_repos)
@@ -0,0 +1,274 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import io
+import os
+import zlib
+import hashlib
+import threading
+from subprocess import PIPE
+from tempfile import NamedTemporaryFile
+
+from gitdb.util import hex_to_bin
+
+CHUNK_SIZE = 64 * 2 ** 10
+
+
+class BlobReader(io.RawIOBase):
+    """
+    Read only, binary file like object with the content of a git blob.
+
+    The content is read lazily from the output of a ``git cat-file``
+    process, so memory use does not depend on the size of the blob. Close
+    it when done, so that the process does not linger.
+    """
+
+    def __init__(self, repo, hexsha):
+        self._cmd = repo.git.cat_file('blob', hexsha, as_process=True)
+        self._stream = self._cmd.proc.stdout
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._stream.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def close(self):
+        if not self.closed:
+            proc = self._cmd.proc
+            if proc.poll() is None:
+                # closed before reading it all
+                proc.kill()
+            proc.wait()
+            self._cmd.proc = None
+            self._stream.close()
+            proc.stderr.close()
+        super(BlobReader, self).close()
+
+
+def read_blobs(repo, hexshas):
+    """
+    Iterate over the blobs with the given ids, yielding a (hexsha, data)
+    tuple for each, in order, all read from a single ``git cat-file
+    --batch`` process. Blobs that are missing are skipped.
+    """
+    hexshas = list(hexshas)
+    if not hexshas:
+        return
+    cmd = repo.git.cat_file('--batch', as_process=True, istream=PIPE)
+    proc = cmd.proc
+
+    def feed():
+        # feed the ids from another thread, so that neither end of the
+        # pipes fills up while the other waits
+        try:
+            for hexsha in hexshas:
+                proc.stdin.write(hexsha + '\n')
+            proc.stdin.close()
+        except (IOError, OSError):
+            # the process was killed before reading it all
+            pass
+    feeder = threading.Thread(target=feed, name='vff-read-blobs')
+    feeder.daemon = True
+    feeder.start()
+    try:
+        for hexsha in hexshas:
+            header = proc.stdout.readline().split()
+            if len(header) != 3:
+                # '<sha> missing'
+                continue
+            data = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)
+            yield header[0], data
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        feeder.join()
+        cmd.proc = None
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+class BlobWriter(object):
+    """
+    Write a new blob, that is size bytes long, straight into the loose
+    objects of a repository, hashing and compressing it as it is written,
+    so that each byte is only read once.
+
+    If path is given, the content is also written to a temporary file
+    next to it, that replaces path when install() is called; call
+    discard() instead to leave path untouched.
+    """
+
+    def __init__(self, repo, size, path=None):
+        self.size = size
+        self.path = path
+        self.written = 0
+        self.objects_dir = os.path.join(repo.git_dir, 'objects')
+        self._sha = hashlib.sha1()
+        self._zip = zlib.compressobj(zlib.Z_BEST_SPEED)
+        self._obj = NamedTemporaryFile(dir=self.objects_dir,
+                                       prefix='tmp_obj_', delete=False)
+        self._file = None
+        if path is not None:
+            self._file = NamedTemporaryFile(dir=os.path.dirname(path),
+                                            prefix='.vff-tmp-', delete=False)
+        self._put_object(b'blob %d\x00' % size)
+
+    def _put_object(self, data):
+        self._sha.update(data)
+        self._obj.write(self._zip.compress(data))
+
+    def write(self, data):
+        self._put_object(data)
+        if self._file is not None:
+            self._file.write(data)
+        self.written += len(data)
+
+    def close(self):
+        """
+        Store the blob in the object database, and return its binary sha.
+        """
+        try:
+            if self.written != self.size:
+                raise IOError('Expected %d bytes of content, got %d.'
+                              % (self.size, self.written))
+            self._obj.write(self._zip.flush())
+            self._obj.close()
+            if self._file is not None:
+                self._file.close()
+            hexsha = self._sha.hexdigest()
+            obj_dir = os.path.join(self.objects_dir, hexsha[:2])
+            obj_path = os.path.join(obj_dir, hexsha[2:])
+            if os.path.exists(obj_path):
+                os.unlink(self._obj.name)
+            else:
+                if not os.path.isdir(obj_dir):
+                    try:
+                        os.mkdir(obj_dir)
+                    except OSError:
+                        # created meanwhile by someone else
+                        pass
+                os.chmod(self._obj.name, 0o444)
+                os.rename(self._obj.name, obj_path)
+        except:
+            self.abort()
+            raise
+        self.binsha = hex_to_bin(hexsha)
+        return self.binsha
+
+    def install(self, permissions=None):
+        """
+        Move the written content into path.
+        """
+        if permissions is not None:
+            os.chmod(self._file.name, permissions)
+        os.rename(self._file.name, self.path)
+        self._file = None
+
+    def detach(self):
+        """
+        Leave the written content in its temporary file, next to path,
+        and return the name of that file, for the caller to move it into
+        path (or remove it) later.
+        """
+        name = self._file.name
+        self._file = None
+        return name
+
+    def discard(self):
+        """
+        Throw away the content written for path.
+        """
+        if self._file is not None:
+            self._file.close()
+            if os.path.exists(self._file.name):
+                os.unlink(self._file.name)
+            self._file = None
+
+    def abort(self):
+        """
+        Throw away everything written so far.
+        """
+        self.discard()
+        self._obj.close()
+        if os.path.exists(self._obj.name):
+            os.unlink(self._obj.name)
+
+
+def iter_chunks(content, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over the content of a django File (or of any file like object
+    with read, and maybe seek) in chunks.
+    """
+    if hasattr(content, 'chunks'):
+        return content.chunks(chunk_size)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return iter(lambda: content.read(chunk_size), b'')
+
+
+def content_size(content):
+    """
+    Return the size of a django File, or None if it cannot be known
+    without reading it.
+    """
+    try:
+        return content.size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def write_blob(repo, content, path=None, size=None):
+    """
+    Write content, a django File or a file like object, to a BlobWriter
+    and close it. Return the writer.
+    """
+    if size is None:
+        size = content_size(content)
+    writer = BlobWriter(repo, size, path)
+    try:
+        for chunk in iter_chunks(content):
+            writer.write(chunk)
+    except:
+        writer.abort()
+        raise
+    writer.close()
+    return writer
+
+
+def store_file(repo, path):
+    """
+    Store the file at path as a blob, and return its binary sha.
+    """
+    with open(path, 'rb') as f:
+        return write_blob(repo, f, size=os.fstat(f.fileno()).st_size).binsha
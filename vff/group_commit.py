@@ -0,0 +1,275 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import re
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger('vff')
+
+TRAILER = u'Vff-Change: '
+SUBJECT = re.compile(r'vff: group commit of (\d+) changes$')
+# the committer of group commits, that tells them from ordinary commits
+# whose messages happen to look like them
+COMMITTER_NAME = u'vff'
+COMMITTER_EMAIL = u'vff-group-commit@localhost'
+
+
+class CommitFuture(object):
+    """
+    The eventual result of a write queued for a group commit. result()
+    returns the versionid of the commit that made the write durable.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._versionid = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Timed out waiting for the vff commit.')
+        if self._exception is not None:
+            raise self._exception
+        return self._versionid
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Timed out waiting for the vff commit.')
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        Call fn with this future as its only argument once the write is
+        durable (or has failed). If that has already happened, call it
+        right away.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, versionid=None, exception=None):
+        with self._lock:
+            self._versionid = versionid
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception('Error in a vff commit callback')
+
+    def set_result(self, versionid):
+        self._set(versionid=versionid)
+
+    def set_exception(self, exception):
+        self._set(exception=exception)
+
+
+class PendingChange(object):
+    """
+    A write waiting in a CommitQueue.
+    """
+
+    def __init__(self, fname, binsha, commit_msg, username):
+        self.fname = fname
+        # the blob with the new content, None to delete the file
+        self.binsha = binsha
+        self.commit_msg = commit_msg
+        self.username = username
+        self.future = CommitFuture()
+
+
+def format_group_message(changes, author_name):
+    """
+    Build the message of a commit grouping several changes. Each change
+    gets a trailer line that records the author and commit message of
+    the original write, so that they can be attributed per file.
+    """
+    lines = [u'vff: group commit of %d changes' % len(changes), u'']
+    for change in changes:
+        record = {'path': change.fname,
+                  'author': author_name(change.username),
+                  'message': change.commit_msg}
+        if isinstance(record['message'], str):
+            record['message'] = record['message'].decode('utf8')
+        lines.append(TRAILER + json.dumps(record, sort_keys=True))
+    return u'\n'.join(lines)
+
+
+def parse_group_message(message):
+    """
+    Return a dictionary mapping each path recorded in the trailers of a
+    group commit message to an (author, message) tuple. For ordinary
+    commit messages, including those that only look like group commit
+    messages, return an empty dictionary.
+    """
+    lines = message.splitlines()
+    match = lines and SUBJECT.match(lines[0])
+    if not match:
+        return {}
+    records = {}
+    for line in lines[1:]:
+        if not line.startswith(TRAILER):
+            continue
+        try:
+            record = json.loads(line[len(TRAILER):])
+            records[record['path']] = (record['author'], record['message'])
+        except (ValueError, TypeError, KeyError):
+            return {}
+    if len(records) != int(match.group(1)):
+        return {}
+    return records
+
+
+def escape_message(message):
+    """
+    Indent the lines of an ordinary commit message that would pass for
+    group commit trailers, so that they cannot forge the attribution of
+    other documents.
+    """
+    if not message or TRAILER.strip() not in message:
+        return message
+    if isinstance(message, str):
+        message = message.decode('utf8')
+    return u'\n'.join(line.startswith(TRAILER.strip()) and u' ' + line or line
+                      for line in message.split(u'\n'))
+
+
+class CommitQueue(object):
+    """
+    Collect writes coming from many requests and commit them together.
+
+    A batch is committed when the oldest pending change has waited for
+    ``window`` seconds, or as soon as there are ``batch_size`` pending
+    changes. ``flush`` is called, from a background thread, with the list
+    of PendingChange objects of each batch, and must return the versionid
+    of the commit that includes them.
+    """
+
+    def __init__(self, flush, window=0.05, batch_size=100):
+        self.flush = flush
+        self.window = window
+        self.batch_size = batch_size
+        self._cond = threading.Condition()
+        self._pending = []
+        self._in_flight = set()
+        self._closed = False
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run,
+                                            name='vff-group-commit')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, fname, binsha, commit_msg, username):
+        """
+        Queue a change and return a CommitFuture for it. If there is an
+        uncommitted change for fname already, wait for it to be committed
+        first, so that a batch never has two changes for the same file;
+        the check and the queueing are done holding the lock.
+        """
+        change = PendingChange(fname, binsha, commit_msg, username)
+        with self._cond:
+            self._wait_for(fname)
+            if self._closed:
+                raise RuntimeError('The vff commit queue is closed.')
+            self._start()
+            self._pending.append(change)
+            self._cond.notify_all()
+        return change.future
+
+    def wait_for(self, fname):
+        """
+        Block until there are no uncommitted changes for fname, so that a
+        new write to the same file does not get mixed with them.
+        """
+        with self._cond:
+            self._wait_for(fname)
+
+    def _wait_for(self, fname):
+        # with self._cond held
+        while (fname in self._in_flight or
+               any(c.fname == fname for c in self._pending)):
+            self._cond.wait()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if self._pending and not self._closed:
+                deadline = time.time() + self.window
+                while len(self._pending) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or self._closed:
+                        break
+                    self._cond.wait(remaining)
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            self._in_flight = set(c.fname for c in batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                versionid = self.flush(batch)
+            except Exception as e:
+                for change in batch:
+                    change.future.set_exception(e)
+            else:
+                for change in batch:
+                    change.future.set_result(versionid)
+            with self._cond:
+                self._in_flight = set()
+                self._cond.notify_all()
+
+    def close(self):
+        """
+        Commit whatever is pending and stop the background thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,403 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+"""
+Instrumentation of django-vff, enabled with VFF_INSTRUMENT: every
+operation of the backends, of the storage and of the git work underneath
+is timed, and reported with the bytes it moved and the git processes it
+ran, through the operation_done signal and the sink in VFF_METRICS_SINK.
+
+Operations are named after where they happen: 'storage.save',
+'storage.delete', 'storage.bulk_save' and 'storage.bulk_delete' for the
+storage, 'backend.<method>' for the methods of the backends, and
+'git.write', 'git.index', 'git.commit' and 'git.history' for the parts of
+the git backend that write blobs, update the index, commit and walk the
+history. Operations within operations (e.g. the add_revision of a save)
+are reported too, but only the outermost ones count in the summary of a
+request (see InstrumentationMiddleware).
+"""
+
+import time
+import socket
+import threading
+from django.utils.importlib import import_module
+
+import git
+from django.conf import settings
+from django.dispatch import Signal
+
+from vff.abcs import AsyncBackend
+from vff.git_stream import content_size
+
+# sent at the end of each operation, by the class of the storage or backend
+# that made it, with its name, its duration in seconds, the number of bytes
+# read or written (or None), the number of git processes it ran, and the
+# exception it raised, if any
+operation_done = Signal(providing_args=['operation', 'duration', 'nbytes',
+                                        'git_calls', 'error'])
+
+# counters of the current thread: git_calls, depth (of nested operations)
+# and request (the summary of the request being served, if any)
+_local = threading.local()
+
+
+def enabled():
+    return getattr(settings, 'VFF_INSTRUMENT', False)
+
+
+class measure(object):
+    """
+    Context manager that times the operation run within it, and reports
+    it, if instrumentation is enabled. The bytes it moved can be set as
+    the nbytes attribute of the object it returns.
+    """
+
+    def __init__(self, operation, sender):
+        self.operation = operation
+        self.sender = sender
+        self.nbytes = None
+        self.start = None
+
+    def __enter__(self):
+        if enabled():
+            self.git_calls = getattr(_local, 'git_calls', 0)
+            _local.depth = getattr(_local, 'depth', 0) + 1
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.start is None:
+            return
+        duration = time.time() - self.start
+        _local.depth -= 1
+        git_calls = getattr(_local, 'git_calls', 0) - self.git_calls
+        request = getattr(_local, 'request', None)
+        if request is not None and _local.depth == 0:
+            request['operations'] += 1
+            request['duration'] += duration
+        record(self.operation, self.sender, duration, self.nbytes,
+               git_calls, exc_value)
+
+
+def timed(operation):
+    """
+    Decorator for methods that are operations of their own.
+    """
+    def decorator(method):
+        def wrapper(self, *args, **kwargs):
+            with measure(operation, self):
+                return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorator
+
+
+def record(operation, sender, duration, nbytes, git_calls, error=None):
+    """
+    Report an operation to the receivers of operation_done and to the
+    metrics sink.
+    """
+    if not isinstance(sender, type):
+        sender = sender.__class__
+    operation_done.send(sender=sender, operation=operation,
+                        duration=duration, nbytes=nbytes,
+                        git_calls=git_calls, error=error)
+    sink = get_sink()
+    if sink is not None:
+        sink.record(operation, duration, nbytes, git_calls, error)
+
+
+class MetricsSink(object):
+    """
+    Receives the metrics of the operations. Subclasses send them somewhere,
+    implementing timing and incr; VFF_METRICS_SINK is the dotted path to
+    the subclass to use, which is built with no arguments.
+    """
+
+    def record(self, operation, duration, nbytes, git_calls, error=None):
+        self.timing(operation, duration)
+        if nbytes:
+            self.incr(operation + '.bytes', nbytes)
+        if git_calls:
+            self.incr(operation + '.git_calls', git_calls)
+        if error is not None:
+            self.incr(operation + '.errors')
+
+    def timing(self, name, seconds):
+        raise NotImplementedError
+
+    def incr(self, name, value=1):
+        raise NotImplementedError
+
+
+class StatsdSink(MetricsSink):
+    """
+    Sends the metrics to statsd, over UDP, to VFF_STATSD_HOST (localhost)
+    and VFF_STATSD_PORT (8125), prefixed with VFF_STATSD_PREFIX ('vff').
+    Metrics that cannot be sent are lost.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (
+            host or getattr(settings, 'VFF_STATSD_HOST', 'localhost'),
+            port or getattr(settings, 'VFF_STATSD_PORT', 8125))
+        if prefix is None:
+            prefix = getattr(settings, 'VFF_STATSD_PREFIX', 'vff')
+        self.prefix = prefix and prefix + '.' or ''
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, stat):
+        try:
+            self.socket.sendto(self.prefix + stat, self.address)
+        except (socket.error, socket.gaierror):
+            pass
+
+    def timing(self, name, seconds):
+        self.send('%s:%.3f|ms' % (name, seconds * 1000))
+
+    def incr(self, name, value=1):
+        self.send('%s:%d|c' % (name, value))
+
+
+class MemorySink(MetricsSink):
+    """
+    Keeps the metrics in memory, for tests: timings maps each name to the
+    list of its durations, in seconds, and counters each name to its total.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+    def timing(self, name, seconds):
+        with self.lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+_sink = None
+_sink_path = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """
+    Return the instance of the sink in VFF_METRICS_SINK, or None.
+    """
+    global _sink, _sink_path
+    path = getattr(settings, 'VFF_METRICS_SINK', None)
+    if path is None:
+        return None
+    with _sink_lock:
+        if path != _sink_path:
+            mname = '.'.join(path.split('.')[:-1])
+            cname = path.split('.')[-1]
+            _sink = getattr(import_module(mname), cname)()
+            _sink_path = path
+        return _sink
+
+
+class CountingGit(git.cmd.Git):
+    """
+    git command wrapper that counts the git processes it runs, in the
+    current thread. It only adds behaviour, so that the wrapper of a repo
+    can be switched to it, see count_git_calls.
+    """
+
+    __slots__ = ()
+
+    def execute(self, *args, **kwargs):
+        _local.git_calls = getattr(_local, 'git_calls', 0) + 1
+        return super(CountingGit, self).execute(*args, **kwargs)
+
+
+def count_git_calls(repo):
+    """
+    Have the git processes run for repo counted, if instrumentation is
+    enabled.
+    """
+    if enabled() and type(repo.git) is git.cmd.Git:
+        repo.git.__class__ = CountingGit
+
+
+def _nbytes(text):
+    if isinstance(text, unicode):
+        return len(text.encode('utf8'))
+    if isinstance(text, str):
+        return len(text)
+    return None
+
+
+class InstrumentedBackend(AsyncBackend):
+    """
+    Wraps a backend, and measures the calls to its methods as
+    'backend.<method>' operations. The storage wraps its backend in one
+    when VFF_INSTRUMENT is set. Calls of the async API are measured in
+    the threads that run them. The bytes of a write are those of its
+    contents, and those of a read the utf8 bytes of the text it returns;
+    open_revision reads lazily, so its bytes are not known.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name == 'get_size':
+            def get_size(*args, **kwargs):
+                with measure('backend.get_size', self.backend):
+                    return attr(*args, **kwargs)
+            return get_size
+        return attr
+
+    def get_executor(self, instance):
+        return self.backend.get_executor(instance)
+
+    def get_filename(self, instance):
+        return self.backend.get_filename(instance)
+
+    def check(self):
+        return self.backend.check()
+
+    def add_revision(self, content, instance, commit_msg, username,
+                     callback=None):
+        with measure('backend.add_revision', self.backend) as m:
+            m.nbytes = content_size(content)
+            return self.backend.add_revision(content, instance, commit_msg,
+                                             username, callback=callback)
+
+    def del_document(self, instance, commit_msg, username, callback=None):
+        with measure('backend.del_document', self.backend):
+            return self.backend.del_document(instance, commit_msg, username,
+                                             callback=callback)
+
+    def bulk_add_revisions(self, revisions, commit_msg, username,
+                           callback=None):
+        revisions = list(revisions)
+        with measure('backend.bulk_add_revisions', self.backend) as m:
+            m.nbytes = sum(content_size(content) or 0
+                           for instance, content in revisions)
+            return self.backend.bulk_add_revisions(revisions, commit_msg,
+                                                   username,
+                                                   callback=callback)
+
+    def bulk_del_documents(self, instances, commit_msg, username,
+                           callback=None):
+        with measure('backend.bulk_del_documents', self.backend):
+            return self.backend.bulk_del_documents(instances, commit_msg,
+                                                   username,
+                                                   callback=callback)
+
+    def list_revisions(self, instance, count=0, offset=0, after=None):
+        with measure('backend.list_revisions', self.backend):
+            return self.backend.list_revisions(instance, count=count,
+                                               offset=offset, after=after)
+
+    def count_revisions(self, instance):
+        with measure('backend.count_revisions', self.backend):
+            return self.backend.count_revisions(instance)
+
+    def get_revision(self, instance, rev=None):
+        with measure('backend.get_revision', self.backend) as m:
+            text = self.backend.get_revision(instance, rev=rev)
+            m.nbytes = _nbytes(text)
+            return text
+
+    def open_revision(self, instance, rev=None):
+        with measure('backend.open_revision', self.backend):
+            return self.backend.open_revision(instance, rev=rev)
+
+    def prefetch_revisions(self, instances, rev=None, metadata=True):
+        with measure('backend.prefetch_revisions', self.backend) as m:
+            prefetched = self.backend.prefetch_revisions(instances, rev=rev,
+                                                         metadata=metadata)
+            m.nbytes = sum(_nbytes(content) or 0
+                           for content, latest in prefetched.values())
+            return prefetched
+
+    def latest_metadata(self, instances):
+        with measure('backend.latest_metadata', self.backend):
+            return self.backend.latest_metadata(instances)
+
+    def get_diff(self, instance, id1, id2, **options):
+        with measure('backend.get_diff', self.backend) as m:
+            diff = self.backend.get_diff(instance, id1, id2, **options)
+            m.nbytes = _nbytes(diff)
+            return diff
+
+
+def start_request():
+    """
+    Start the summary of the operations made by the current thread.
+    """
+    _local.request = {'operations': 0, 'duration': 0.0,
+                      'git_calls': getattr(_local, 'git_calls', 0)}
+
+
+def end_request():
+    """
+    Return the summary started by start_request, a dictionary with the
+    number of (outermost) operations, their total duration in seconds and
+    the number of git processes run since, or None if none was started.
+    """
+    request = getattr(_local, 'request', None)
+    if request is None:
+        return None
+    _local.request = None
+    request['git_calls'] = getattr(_local, 'git_calls', 0) - \
+        request['git_calls']
+    return request
+
+
+class InstrumentationMiddleware(object):
+    """
+    Summarizes the django-vff work done to serve each request, if
+    instrumentation is enabled; in DEBUG mode, the summary is added to the
+    response as an X-VFF header, e.g. 'operations=3; time=12.5ms; git=2'.
+    """
+
+    def process_request(self, request):
+        if enabled():
+            start_request()
+
+    def process_response(self, request, response):
+        summary = end_request()
+        if summary is not None and settings.DEBUG:
+            response['X-VFF'] = 'operations=%d; time=%.1fms; git=%d' % (
+                summary['operations'], summary['duration'] * 1000,
+                summary['git_calls'])
+        return response
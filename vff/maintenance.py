@@ -0,0 +1,149 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import os
+import time
+import fcntl
+import errno
+
+import git
+
+from vff.git_repo import RefreshingGitDB
+
+# unreachable objects younger than this are kept by a full maintenance
+# run, so that objects written by writes still in progress are not lost
+PRUNE_EXPIRE = '2.weeks.ago'
+
+
+def count_objects(repo):
+    """
+    Return the output of ``git count-objects -v`` as a dictionary, with
+    the number of loose objects ('count'), of packs ('packs'), etc.
+    """
+    stats = {}
+    for line in repo.git.count_objects('-v').splitlines():
+        key, value = line.split(':', 1)
+        try:
+            stats[key.strip().replace('-', '_')] = int(value)
+        except ValueError:
+            pass
+    return stats
+
+
+def probe(repo, fname=None, repeat=3):
+    """
+    Return the time, in seconds (the best of repeat), that it takes to list
+    the revisions of fname walking the history of repo, as list_revisions
+    does when there is no revision index. By default, fname is the first
+    file of the root commit, so the whole history is walked.
+    """
+    if fname is None:
+        try:
+            root = repo.git.rev_list('--max-parents=0', 'HEAD').split()[-1]
+        except git.exc.GitCommandError:
+            # no commits
+            return None
+        paths = repo.git.ls_tree('-r', '--name-only', root).splitlines()
+        if not paths:
+            return None
+        fname = paths[0]
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        list(repo.iter_commits(paths=fname))
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def tasks(incremental=False, prune_expire=PRUNE_EXPIRE):
+    """
+    Return the git commands, (name, args) tuples, of a maintenance run.
+
+    An incremental run packs the loose objects into a new pack, leaving
+    the existing packs alone, and adds a layer to the commit graph. A full
+    run repacks everything into a single pack, prunes unreachable objects
+    older than prune_expire, and rewrites the commit graph. Both write
+    changed path Bloom filters into the commit graph, that let git skip
+    most commits when walking the history of a single file. None of them
+    gets in the way of readers or writers.
+    """
+    if incremental:
+        return [
+            ('repack', ['repack', '-d', '-l', '-q']),
+            ('prune-packed', ['prune-packed', '-q']),
+            ('commit-graph', ['commit-graph', 'write', '--reachable',
+                              '--changed-paths', '--split']),
+        ]
+    return [
+        ('repack', ['repack', '-a', '-d', '-l', '-q']),
+        # refs are not packed, since the packed-refs files of recent gits
+        # cannot be read by GitPython 0.3
+        ('prune', ['prune', '--expire=%s' % prune_expire]),
+        ('commit-graph', ['commit-graph', 'write', '--reachable',
+                          '--changed-paths', '--split=replace']),
+    ]
+
+
+def maintain(location, incremental=False, prune_expire=PRUNE_EXPIRE,
+             run_probe=True):
+    """
+    Run the maintenance tasks (see tasks()) on the repository at location,
+    unless another maintenance run is already at it, and return a report:
+    a dictionary with the count_objects() before and after, the time taken
+    by each task, and the probe() latency before and after. Return None if
+    the repository was already being maintained.
+
+    The live processes need not stop: git packs and prunes objects safely
+    under their feet, and their object databases look for the new packs
+    when they miss an object (see vff.git_repo.RefreshingGitDB).
+    """
+    repo = git.Repo(location, odbt=RefreshingGitDB)
+    lock = open(os.path.join(repo.git_dir, 'vff-maintenance.lock'), 'a')
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        report = {'objects_before': count_objects(repo), 'tasks': []}
+        if run_probe:
+            report['probe_before'] = probe(repo)
+        for name, args in tasks(incremental, prune_expire):
+            start = time.time()
+            repo.git.execute(['git'] + args)
+            report['tasks'].append((name, time.time() - start))
+        report['objects_after'] = count_objects(repo)
+        if run_probe:
+            report['probe_after'] = probe(repo)
+        return report
+    finally:
+        lock.close()
+        repo.git.clear_cache()
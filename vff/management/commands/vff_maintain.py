@@ -0,0 +1,85 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+from django.core.management.base import BaseCommand
+
+from vff.field import versioned_fields
+from vff.maintenance import PRUNE_EXPIRE, maintain
+
+
+class Command(BaseCommand):
+    help = ('Repack and prune the git repositories used by the versioned'
+            ' file fields, and write their commit graphs. Safe to run while'
+            ' the site is live.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only pack the loose objects and add to'
+                                 ' the commit graph; cheap enough to run'
+                                 ' often.')
+        parser.add_argument('--prune-expire', default=PRUNE_EXPIRE,
+                            help='Keep unreachable objects younger than'
+                                 ' this (default %s).' % PRUNE_EXPIRE)
+        parser.add_argument('--no-probe', action='store_false',
+                            dest='probe',
+                            help='Do not time list_revisions before and'
+                                 ' after.')
+
+    def handle(self, *args, **options):
+        done = set()
+        for model, field in versioned_fields():
+            # sharded backends have a backend per shard
+            backends = getattr(field.storage.backend, 'backends',
+                               [field.storage.backend])
+            for backend in backends:
+                location = getattr(backend, 'location', None)
+                if location is None or location in done:
+                    continue
+                done.add(location)
+                report = maintain(location, options['incremental'],
+                                  options['prune_expire'], options['probe'])
+                if report is None:
+                    self.stdout.write('%s: already being maintained'
+                                      % location)
+                    continue
+                self.stdout.write(self.format_report(location, report))
+
+    def format_report(self, location, report):
+        before = report['objects_before']
+        after = report['objects_after']
+        lines = [location,
+                 '  loose objects: %d -> %d, packs: %d -> %d' % (
+                     before.get('count', 0), after.get('count', 0),
+                     before.get('packs', 0), after.get('packs', 0))]
+        for name, seconds in report['tasks']:
+            lines.append('  %s: %.2fs' % (name, seconds))
+        if report.get('probe_before') is not None:
+            lines.append('  list_revisions probe: %.1fms -> %.1fms' % (
+                report['probe_before'] * 1000,
+                report['probe_after'] * 1000))
+        return '\n'.join(lines)
@@ -0,0 +1,76 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import os
+
+import git
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from vff.db_backend import DBBackend, import_history
+from vff.sharded_backend import shard_roots
+
+
+class Command(BaseCommand):
+    help = ('Copy the documents in the git repositories, with all their'
+            ' history, into the database backend'
+            ' (vff.db_backend.DBBackend), keeping their versionids.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', action='append', dest='sources',
+                            default=[],
+                            help='A git repository to copy; can be given'
+                                 ' several times. Defaults to the one at'
+                                 ' VFF_REPO_ROOT or, if there is none, to'
+                                 ' the shards.')
+
+    def handle(self, *args, **options):
+        backend = DBBackend(None)
+        problems = backend.check()
+        if problems:
+            raise CommandError(problems[0])
+        if backend.documents.exists():
+            raise CommandError('There are documents in the database'
+                               ' already.')
+        sources = options['sources'] or self.default_sources()
+        if not sources:
+            raise CommandError('There are no git repositories to copy.')
+        count = import_history(sources, backend)
+        self.stdout.write('Copied %d revisions of %d documents from %s'
+                          % (count, backend.documents.count(),
+                             ', '.join(sources)))
+
+    def default_sources(self):
+        location = getattr(settings, 'VFF_REPO_ROOT',
+                           os.path.join(settings.MEDIA_ROOT, 'vf_repo'))
+        try:
+            git.Repo(location)
+            return [location]
+        except (git.exc.NoSuchPathError,
+                git.exc.InvalidGitRepositoryError):
+            return [root for root in shard_roots() if os.path.isdir(root)]
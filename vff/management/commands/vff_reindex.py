@@ -0,0 +1,56 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vff.field import versioned_fields
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the revision index of the git repositories used by'
+            ' the versioned file fields (see VFF_REVISION_INDEX).')
+
+    def handle(self, *args, **options):
+        done = set()
+        for model, field in versioned_fields():
+            # sharded backends have a backend per shard
+            backends = getattr(field.storage.backend, 'backends',
+                               [field.storage.backend])
+            for backend in backends:
+                if not hasattr(backend, 'rebuild_revision_index'):
+                    continue
+                if backend.shared.revision_index is None:
+                    raise CommandError('The revision index is not enabled,'
+                                       ' set VFF_REVISION_INDEX in'
+                                       ' settings.py.')
+                if backend.location in done:
+                    continue
+                backend.rebuild_revision_index()
+                done.add(backend.location)
+                self.stdout.write('Rebuilt the revision index of %s'
+                                  % backend.location)
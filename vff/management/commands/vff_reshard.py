@@ -0,0 +1,65 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from vff.sharded_backend import get_router, reshard, shard_roots
+
+
+class Command(BaseCommand):
+    help = ('Spread the documents in existing git repositories over the'
+            ' shards used by ShardedGitBackend, keeping their history.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', action='append', dest='sources',
+                            help='Root of a repository to reshard; can be'
+                                 ' given more than once. Defaults to'
+                                 ' VFF_REPO_ROOT.')
+        parser.add_argument('--shards', type=int,
+                            help='Number of shards to spread the documents'
+                                 ' over. Defaults to VFF_SHARDS.')
+
+    def handle(self, *args, **options):
+        sources = options['sources'] or [
+            getattr(settings, 'VFF_REPO_ROOT',
+                    os.path.join(settings.MEDIA_ROOT, 'vf_repo'))]
+        sources = [os.path.abspath(source) for source in sources]
+        targets = shard_roots(options['shards'])
+        if set(sources) & set(targets):
+            raise CommandError('The shards cannot be resharded in place;'
+                               ' move them away and pass them as --source.')
+        try:
+            counts = reshard(sources, targets, get_router(len(targets)),
+                             bare=getattr(settings, 'VFF_BARE_REPO', False))
+        except ValueError as e:
+            raise CommandError(str(e))
+        for target, count in zip(targets, counts):
+            self.stdout.write('%s: %d commits' % (target, count))
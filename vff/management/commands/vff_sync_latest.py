@@ -0,0 +1,59 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+from django.core.management.base import BaseCommand
+
+from vff.field import versioned_fields
+
+# instances synced at once
+BATCH = 1000
+
+
+class Command(BaseCommand):
+    help = ('Fill in the latest columns of the versioned file fields that'
+            ' have them (see the latest_columns argument of'
+            ' VersionedFileField) from their repositories.')
+
+    def handle(self, *args, **options):
+        for model, field in versioned_fields():
+            if not field.latest_columns:
+                continue
+            count = 0
+            batch = []
+            for instance in model._default_manager.iterator():
+                batch.append(instance)
+                if len(batch) == BATCH:
+                    field.storage.bulk_sync_latest(batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                field.storage.bulk_sync_latest(batch)
+                count += len(batch)
+            self.stdout.write('Synced %d %s.%s.%s documents'
+                              % (count, model._meta.app_label,
+                                 model._meta.object_name, field.name))
@@ -0,0 +1,82 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+from django.db import models
+
+
+class Document(models.Model):
+    """
+    A document kept by vff.db_backend.DBBackend, with the full content of
+    its latest revision, so that reading it takes a single row.
+    """
+
+    fname = models.CharField(max_length=255, unique=True)
+    # None once removed
+    content = models.BinaryField(null=True)
+    revcount = models.PositiveIntegerField(default=0)
+    # the number of the latest revision stored in full
+    snapshot = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return self.fname
+
+
+class Revision(models.Model):
+    """
+    A revision of a Document. Its data is zlib compressed, and is either
+    the full content (a snapshot) or a delta from the previous revision
+    (see vff.db_backend.make_delta).
+    """
+
+    SNAPSHOT = 0
+    DELTA = 1
+    REMOVED = 2
+    KINDS = (
+        (SNAPSHOT, 'snapshot'),
+        (DELTA, 'delta'),
+        (REMOVED, 'removed'),
+    )
+
+    document = models.ForeignKey(Document, related_name='revisions')
+    # 1 for the first revision of the document, 2 for the next, etc.
+    number = models.PositiveIntegerField()
+    versionid = models.CharField(max_length=40)
+    author = models.CharField(max_length=255)
+    message = models.TextField(blank=True)
+    date = models.DateTimeField()
+    kind = models.PositiveSmallIntegerField(choices=KINDS)
+    data = models.BinaryField()
+    size = models.BigIntegerField(null=True)
+
+    class Meta:
+        ordering = ['-number']
+        unique_together = (('document', 'number'),
+                           ('document', 'versionid'))
+
+    def __unicode__(self):
+        return u'%s@%s' % (self.document_id, self.versionid)
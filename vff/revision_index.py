@@ -0,0 +1,195 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import sqlite3
+import datetime
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS revisions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fname TEXT NOT NULL,
+    versionid TEXT NOT NULL,
+    author TEXT NOT NULL,
+    message TEXT NOT NULL,
+    date INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS revisions_fname ON revisions (fname, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+class RevisionIndex(object):
+    """
+    A SQLite index of the revisions of every document in a repository,
+    so that listing the revisions of a document does not need to walk
+    the history of the whole repository.
+
+    The index records the head commit it is up to date with. Writers add
+    the revisions of their commits together with the new head; if the
+    head recorded is not the parent of the new commit, the index is left
+    alone, and it will catch up with the repository history the next
+    time it is read (see update()).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _get_head(self):
+        row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'head'").fetchone()
+        return row and row[0]
+
+    def _set_head(self, head):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value)"
+                          " VALUES ('head', ?)", (head,))
+
+    def _insert(self, revisions):
+        self.conn.executemany(
+            "INSERT INTO revisions (fname, versionid, author, message, date)"
+            " VALUES (?, ?, ?, ?, ?)", revisions)
+
+    def record(self, parent, head, revisions):
+        """
+        Add the revisions of the commit head, whose parent is parent.
+        Return whether they were recorded.
+
+        Revisions are given as (fname, versionid, author, message, date)
+        tuples, with the date as a unix timestamp.
+        """
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if self._get_head() != parent:
+                conn.execute('ROLLBACK')
+                return False
+            self._insert(revisions)
+            self._set_head(head)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return True
+
+    def update(self, head, history):
+        """
+        Bring the index up to date with head. history is a callable that,
+        given the head the index is at, returns an iterable with the
+        revision tuples added since then, in chronological order,
+        or None if it cannot tell. Return whether the index is up to date.
+        """
+        indexed = self._get_head()
+        if indexed == head:
+            return True
+        if indexed is None:
+            return False
+        revisions = history(indexed)
+        if revisions is None:
+            return False
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if self._get_head() == indexed:
+                self._insert(revisions)
+                self._set_head(head)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return True
+
+    def rebuild(self, head, revisions):
+        """
+        Replace the contents of the index with revisions, an iterable with
+        all the revision tuples in the history of head, in chronological
+        order.
+        """
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM revisions')
+            self._insert(revisions)
+            self._set_head(head)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def list(self, fname, count=0, offset=0, after=None):
+        """
+        Return the revisions of fname, latest first, as list_revisions
+        in abcs.py. If after is given, only those older than the revision
+        with that versionid; raise ValueError if fname has none such.
+        """
+        query = ('SELECT versionid, author, message, date FROM revisions'
+                 ' WHERE fname = ?')
+        params = [fname]
+        if after is not None:
+            row = self.conn.execute(
+                'SELECT MIN(id) FROM revisions WHERE fname = ? AND'
+                ' versionid = ?', (fname, after)).fetchone()
+            if row[0] is None:
+                raise ValueError('%s has no revision %s' % (fname, after))
+            query += ' AND id < ?'
+            params.append(row[0])
+        rows = self.conn.execute(query + ' ORDER BY id DESC LIMIT ? OFFSET ?',
+                                 params + [count or -1, offset])
+        return [{'versionid': versionid,
+                 'author': author,
+                 'message': message,
+                 'date': datetime.datetime.fromtimestamp(date)}
+                for versionid, author, message, date in rows]
+
+    def count(self, fname):
+        """
+        Return the number of revisions of fname.
+        """
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM revisions WHERE fname = ?',
+            (fname,)).fetchone()[0]
+
+    def latest(self, fname):
+        """
+        Return the latest revision of fname, or None if it has none.
+        """
+        revs = self.list(fname, count=1)
+        return revs and revs[0] or None
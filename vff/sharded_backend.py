@@ -0,0 +1,289 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import os
+import heapq
+import zlib
+
+import git
+from gitdb import IStream
+
+from django.conf import settings
+
+from vff.abcs import AsyncBackend, VFFBackend
+from vff.git_backend import GitBackend, FILEMODE
+from vff.git_objects import create_commit, find_blobs, update_tree
+from vff.git_repo import iter_history
+
+
+def shard_roots(shards=None):
+    """
+    Return the roots of the repositories of the shards: VFF_SHARD_ROOTS,
+    if set, or else as many subdirectories of VFF_REPO_ROOT as shards
+    (VFF_SHARDS by default), named 00, 01, etc.
+    """
+    roots = getattr(settings, 'VFF_SHARD_ROOTS', None)
+    if roots:
+        return [os.path.abspath(root) for root in roots]
+    if shards is None:
+        shards = getattr(settings, 'VFF_SHARDS', 16)
+    location = getattr(settings, 'VFF_REPO_ROOT',
+                       os.path.join(settings.MEDIA_ROOT, 'vf_repo'))
+    return [os.path.abspath(os.path.join(location, '%02d' % i))
+            for i in range(shards)]
+
+
+class ShardRouter(object):
+    """
+    Route documents to shards, either by a per model mapping (model class
+    names, lowercased, to shard numbers) or by the crc32 of the model
+    class name and pk, as used by GitBackend.get_filename.
+    """
+
+    def __init__(self, shards, mapping=None):
+        self.shards = shards
+        self.mapping = dict((name.lower(), shard)
+                            for name, shard in (mapping or {}).items())
+        for name, shard in self.mapping.items():
+            if not 0 <= shard < shards:
+                raise ValueError('VFF_SHARD_MAP maps %s to shard %s, but'
+                                 ' there are only %d shards.'
+                                 % (name, shard, shards))
+
+    def route(self, class_name, pk):
+        shard = self.mapping.get(class_name)
+        if shard is not None:
+            return shard
+        key = ('%s%s' % (class_name, pk)).encode('utf8')
+        return (zlib.crc32(key) & 0xffffffff) % self.shards
+
+    def route_fname(self, fname):
+        """
+        Return the shard of the document with file name fname, or None if
+        fname is not the name of a document.
+        """
+        name = os.path.basename(fname)
+        if '-' not in name or not name.endswith('.xml'):
+            return None
+        key = name.rsplit('-', 1)[0]
+        for class_name, shard in self.mapping.items():
+            if key.startswith(class_name) and key[len(class_name):].isdigit():
+                return shard
+        key = key.encode('utf8')
+        return (zlib.crc32(key) & 0xffffffff) % self.shards
+
+
+def get_router(shards=None):
+    return ShardRouter(shards or len(shard_roots()),
+                       getattr(settings, 'VFF_SHARD_MAP', None))
+
+
+class ShardedGitBackend(AsyncBackend):
+    """
+    Git backend that spreads the documents over several repositories (see
+    shard_roots), so that history walks, index updates and commits in
+    different shards do not get in each other's way. Each document always
+    goes to the same shard, see ShardRouter.
+    """
+
+    def __init__(self, fieldname):
+        for name in ('VFF_REVISION_INDEX', 'VFF_WRITE_BEHIND'):
+            value = getattr(settings, name, None)
+            if value and value is not True:
+                raise ValueError('With ShardedGitBackend, %s can only be'
+                                 ' True, so that each shard keeps its own.'
+                                 % name)
+        self.fieldname = fieldname
+        self.router = get_router()
+        self.backends = [GitBackend(fieldname, location=root)
+                         for root in shard_roots()]
+
+    def shard(self, instance):
+        """
+        Return the GitBackend of the shard of the document of instance.
+        """
+        class_name = instance.__class__.__name__.lower()
+        return self.backends[self.router.route(class_name, instance.pk)]
+
+    def _shard_fname(self, fname):
+        shard = self.router.route_fname(fname)
+        return self.backends[shard or 0]
+
+    def _by_shard(self, items, instance=lambda item: item):
+        shards = {}
+        for item in items:
+            shards.setdefault(self.shard(instance(item)), []).append(item)
+        return shards.items()
+
+    def get_filename(self, instance):
+        return self.backends[0].get_filename(instance)
+
+    def check(self):
+        problems = []
+        for backend in self.backends:
+            problems.extend(backend.check())
+        return problems
+
+    def get_executor(self, instance):
+        return self.shard(instance).get_executor(instance)
+
+    def add_revision(self, content, instance, commit_msg, username,
+                     callback=None):
+        return self.shard(instance).add_revision(content, instance,
+                                                 commit_msg, username,
+                                                 callback)
+
+    def bulk_add_revisions(self, revisions, commit_msg, username,
+                           callback=None):
+        # one commit per shard
+        versionid = None
+        for backend, revs in self._by_shard(revisions, lambda r: r[0]):
+            versionid = backend.bulk_add_revisions(revs, commit_msg,
+                                                   username, callback)
+        return versionid
+
+    def del_document(self, instance, commit_msg, username, callback=None):
+        return self.shard(instance).del_document(instance, commit_msg,
+                                                 username, callback)
+
+    def bulk_del_documents(self, instances, commit_msg, username,
+                           callback=None):
+        versionid = None
+        for backend, insts in self._by_shard(instances):
+            versionid = backend.bulk_del_documents(insts, commit_msg,
+                                                   username, callback)
+        return versionid
+
+    def list_revisions(self, instance, count=0, offset=0, after=None):
+        return self.shard(instance).list_revisions(instance, count=count,
+                                                   offset=offset, after=after)
+
+    def count_revisions(self, instance):
+        return self.shard(instance).count_revisions(instance)
+
+    def get_revision(self, instance, rev=None):
+        return self.shard(instance).get_revision(instance, rev=rev)
+
+    def open_revision(self, instance, rev=None):
+        return self.shard(instance).open_revision(instance, rev=rev)
+
+    def prefetch_revisions(self, instances, rev=None, metadata=True):
+        prefetched = {}
+        for backend, insts in self._by_shard(instances):
+            prefetched.update(backend.prefetch_revisions(insts, rev=rev,
+                                                         metadata=metadata))
+        return prefetched
+
+    def latest_metadata(self, instances):
+        metadata = {}
+        for backend, insts in self._by_shard(instances):
+            metadata.update(backend.latest_metadata(insts))
+        return metadata
+
+    def get_size(self, fname, rev=None):
+        return self._shard_fname(fname).get_size(fname, rev=rev)
+
+    def get_diff(self, instance, r1, r2, **options):
+        return self.shard(instance).get_diff(instance, r1, r2, **options)
+
+    def rebuild_revision_index(self):
+        for backend in self.backends:
+            backend.rebuild_revision_index()
+
+VFFBackend.register(ShardedGitBackend)
+
+
+def _copy_blob(source, target, binsha):
+    if not target.odb.has_object(binsha):
+        stream = source.odb.stream(binsha)
+        target.odb.store(IStream('blob', stream.size, stream))
+
+
+def reshard(sources, targets, router, bare=False):
+    """
+    Spread the documents in the source repositories over the target ones,
+    as router says, replaying the history of the sources, in chronological
+    order, in the targets, with the same authors, committers, dates and
+    messages. Files that are not documents (e.g. READMEs) go to every
+    target. The targets must not have any commits. Return the number of
+    commits made in each target.
+    """
+    sources = [git.Repo(source) for source in sources]
+    for path in targets:
+        try:
+            git.Repo(path).head.commit
+        except (git.exc.NoSuchPathError, git.exc.InvalidGitRepositoryError,
+                ValueError):
+            continue
+        raise ValueError('The repository at %s is not empty.' % path)
+    targets = [git.Repo.init(target, mkdir=True, bare=bare)
+               for target in targets]
+    heads = [None] * len(targets)
+    counts = [0] * len(targets)
+
+    def history(n, source):
+        try:
+            source.head.commit
+        except ValueError:
+            # no commits
+            return
+        for seq, (commit, paths) in enumerate(iter_history(source)):
+            yield commit.committed_date, n, seq, source, commit, paths
+    histories = [history(n, source) for n, source in enumerate(sources)]
+    for date, n, seq, source, commit, paths in heapq.merge(*histories):
+        found = find_blobs(source.odb, commit.tree.binsha, paths)
+        changes = [{} for target in targets]
+        for path in paths:
+            shard = router.route_fname(path)
+            for i in shard is None and range(len(targets)) or [shard]:
+                changes[i][path] = found.get(path)
+        for i, target in enumerate(targets):
+            if not changes[i]:
+                continue
+            for binsha in changes[i].values():
+                if binsha is not None:
+                    _copy_blob(source, target, binsha)
+            parent = heads[i]
+            tree, changed = update_tree(target.odb,
+                                        parent and parent.tree.binsha,
+                                        changes[i], FILEMODE)
+            if not changed:
+                continue
+            heads[i] = create_commit(
+                target, tree, commit.message, parent and [parent] or [],
+                commit.author, commit.committer,
+                commit.authored_date, commit.author_tz_offset,
+                commit.committed_date, commit.committer_tz_offset)
+            counts[i] += 1
+    for target, head in zip(targets, heads):
+        if head is None:
+            continue
+        target.git.update_ref('-m', 'vff: reshard', 'HEAD', head.hexsha)
+        if not bare:
+            target.git.reset('--hard')
+    return counts
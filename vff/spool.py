@@ -0,0 +1,447 @@
+# Copyright 2011 Terena. All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+
+#    2. Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#        and/or other materials provided with the distribution.
+
+# THIS SOFTWARE IS PROVIDED BY TERENA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL TERENA OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of Terena.
+
+import os
+import json
+import time
+import fcntl
+import errno
+import hashlib
+import logging
+import threading
+
+from vff.git_stream import iter_chunks
+from vff.group_commit import CommitFuture
+
+logger = logging.getLogger('vff')
+
+# done markers of writes whose process is gone are removed after this long
+DONE_TTL = 3600
+
+
+class SpoolError(Exception):
+    """
+    A spooled write that could not be committed, and was given up.
+    """
+
+
+class SpoolEntry(object):
+    """
+    A write waiting in a Spool. Its content, if it is not a removal, is in
+    the file at data_path.
+    """
+
+    def __init__(self, spool, name, record):
+        self.spool = spool
+        self.name = name
+        self.id = name.split('.')[0]
+        self.fname = record['fname']
+        self.commit_msg = record['commit_msg']
+        self.username = record['username']
+        self.time = record['time']
+        self.removal = record['removal']
+        self.data_path = os.path.join(spool.path, self.id + '.data')
+        # whether a commit of it was started before, and may have been
+        # made, by a process that crashed before cleaning it up
+        self.replay = os.path.exists(os.path.join(spool.path,
+                                                  self.id + '.intent'))
+
+    def open(self):
+        """
+        Return the content as a binary file, or None for removals. Raise
+        IOError if the entry has been committed (and removed) meanwhile.
+        """
+        if self.removal:
+            return None
+        return open(self.data_path, 'rb')
+
+
+class Spool(object):
+    """
+    Durable, write behind queue of writes, in a local directory.
+
+    submit() stores each write in the directory, fsynced, and returns at
+    once. A background thread in each process commits the spooled writes,
+    oldest first, by calling ``commit`` with batches of SpoolEntry objects
+    with different fnames; ``commit`` must return the versionid of the
+    commit that includes them. A lock file makes sure that only one
+    process commits at a time, so the writes of all processes are
+    committed in order, and writes left behind by dead processes are
+    picked up by the others (or on the next start).
+
+    A write is only removed from the spool after it has been committed,
+    and a marker with the versionid is left in its place, for the process
+    that spooled it to resolve its future. An intent marker is left
+    before committing it, so that if the process crashes after the commit
+    but before the cleanup, the write is flagged as a replay
+    (SpoolEntry.replay) and ``commit`` can check it against HEAD rather
+    than commit it twice.
+
+    A write that fails to commit max_attempts times is moved to the
+    ``dead`` subdirectory, and its future gets the exception (or, in
+    other processes, a SpoolError).
+    """
+
+    def __init__(self, path, commit, poll=0.2, batch_size=100,
+                 max_attempts=5):
+        self.path = path
+        self.commit = commit
+        self.poll = poll
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.dead_path = os.path.join(path, 'dead')
+        for directory in (path, self.dead_path):
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+        self._lock_path = os.path.join(path, 'lock')
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._committed = 0
+        self._last_lag = None
+        # failed commits of each entry, and whether to commit one entry
+        # at a time to tell which one fails; only used holding the lock
+        # file
+        self._attempts = {}
+        self._isolate = False
+
+    def start(self):
+        """
+        Start the background thread, if it is not running. It is also
+        started by submit().
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run,
+                                            name='vff-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _new_id(self):
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+        # ids sort in the order the writes were made, across processes
+        return '%017d-%07d-%07d' % (int(time.time() * 10 ** 6),
+                                    os.getpid(), counter)
+
+    def _tag(self, fname):
+        return hashlib.sha1(fname.encode('utf8')).hexdigest()[:16]
+
+    def submit(self, fname, content, commit_msg, username):
+        """
+        Spool a write of content to fname, or a removal of fname if content
+        is None, and return a CommitFuture for it.
+        """
+        if self._closed:
+            raise RuntimeError('The vff spool is closed.')
+        entry_id = self._new_id()
+        if content is not None:
+            with open(os.path.join(self.path, entry_id + '.data'), 'wb') as f:
+                for chunk in iter_chunks(content):
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        if isinstance(commit_msg, str):
+            commit_msg = commit_msg.decode('utf8')
+        record = {'fname': fname, 'commit_msg': commit_msg,
+                  'username': username, 'time': time.time(),
+                  'removal': content is None}
+        tmp = os.path.join(self.path, '.tmp-' + entry_id)
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        future = CommitFuture()
+        with self._lock:
+            self._futures[entry_id] = future
+        os.rename(tmp, os.path.join(self.path, '%s.%s.json'
+                                    % (entry_id, self._tag(fname))))
+        self._fsync_dir()
+        self.start()
+        self._wake.set()
+        return future
+
+    def _fsync_dir(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _names(self, tag=None):
+        names = [name for name in os.listdir(self.path)
+                 if name.endswith('.json') and
+                 (tag is None or name.split('.')[1] == tag)]
+        names.sort()
+        return names
+
+    def _load(self, name):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return SpoolEntry(self, name, json.load(f))
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                # committed meanwhile
+                return None
+            raise
+
+    def entries(self, fname=None):
+        """
+        Return the spooled writes, of fname if given, oldest first.
+        """
+        tag = fname is not None and self._tag(fname) or None
+        entries = []
+        for name in self._names(tag):
+            entry = self._load(name)
+            if entry is not None and (fname is None or entry.fname == fname):
+                entries.append(entry)
+        return entries
+
+    def latest(self, fname):
+        """
+        Return the latest spooled write of fname, or None.
+        """
+        entries = self.entries(fname)
+        return entries and entries[-1] or None
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll)
+            self._wake.clear()
+            closed = self._closed
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('Error draining the vff spool')
+            self._collect()
+            if closed:
+                return
+
+    def drain(self, wait=False):
+        """
+        Commit everything in the spool. Unless wait is true, give up at
+        once if another process or thread is at it, and leave a write that
+        fails to commit for the next try. With wait, wait for the others,
+        and retry failing writes (every poll seconds, until they are given
+        up), so that the spool is empty when it returns; writes made after
+        a drain with wait are then committed after those before it.
+        """
+        lock = open(self._lock_path, 'a')
+        try:
+            flags = fcntl.LOCK_EX
+            if not wait:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock, flags)
+            except IOError as e:
+                if not wait and e.errno in (errno.EAGAIN, errno.EACCES):
+                    return
+                raise
+            self._clean_done()
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    self._isolate = False
+                    return
+                self._intend(batch)
+                try:
+                    versionid = self.commit(batch)
+                except Exception as e:
+                    logger.exception('Error committing the vff spool')
+                    self._failed(batch, e)
+                    if not wait:
+                        return
+                    time.sleep(self.poll)
+                    continue
+                now = time.time()
+                for entry in batch:
+                    self._attempts.pop(entry.id, None)
+                    self._done(entry, versionid)
+                    self._last_lag = now - entry.time
+                    self._committed += 1
+        finally:
+            lock.close()
+            if wait:
+                # have the futures of the writes committed here resolved
+                self._wake.set()
+
+    def _intend(self, batch):
+        for entry in batch:
+            if not entry.replay:
+                open(os.path.join(self.path, entry.id + '.intent'),
+                     'w').close()
+        self._fsync_dir()
+
+    def _failed(self, batch, exception):
+        """
+        Count a failed commit of batch. Failing batches of several writes
+        are retried one write at a time, to find the culprit, which is
+        given up after max_attempts.
+        """
+        if len(batch) > 1:
+            self._isolate = True
+            return
+        entry = batch[0]
+        attempts = self._attempts.get(entry.id, 0) + 1
+        self._attempts[entry.id] = attempts
+        if attempts >= self.max_attempts:
+            del self._attempts[entry.id]
+            self._bury(entry, exception)
+            self._isolate = False
+
+    def _bury(self, entry, exception):
+        """
+        Give up a write: move it to the dead letter directory, and fail
+        its future.
+        """
+        logger.error('Giving up the vff spooled write %s of %s after %d'
+                     ' attempts', entry.id, entry.fname, self.max_attempts)
+        for name in (entry.name, entry.id + '.data'):
+            path = os.path.join(self.path, name)
+            if os.path.exists(path):
+                os.rename(path, os.path.join(self.dead_path, name))
+        intent = os.path.join(self.path, entry.id + '.intent')
+        if os.path.exists(intent):
+            os.unlink(intent)
+        with self._lock:
+            future = self._futures.pop(entry.id, None)
+        if future is not None:
+            future.set_exception(exception)
+        else:
+            # for the process that spooled it
+            with open(os.path.join(self.path, entry.id + '.failed'),
+                      'w') as f:
+                message = '%s: %s' % (exception.__class__.__name__,
+                                      exception)
+                if isinstance(message, unicode):
+                    message = message.encode('utf8')
+                f.write(message)
+
+    def _next_batch(self):
+        batch = []
+        fnames = set()
+        for name in self._names():
+            entry_id = name.split('.')[0]
+            if os.path.exists(os.path.join(self.path, entry_id + '.done')):
+                # committed, but not cleaned up before a crash
+                self._remove(entry_id, name)
+                continue
+            entry = self._load(name)
+            # writes to the same file go in different commits, in order
+            if entry is None or entry.fname in fnames:
+                break
+            fnames.add(entry.fname)
+            batch.append(entry)
+            if len(batch) == self.batch_size or self._isolate:
+                break
+        return batch
+
+    def _done(self, entry, versionid):
+        done = os.path.join(self.path, entry.id + '.done')
+        with open(done, 'w') as f:
+            f.write(versionid or '')
+        self._remove(entry.id, entry.name)
+
+    def _remove(self, entry_id, name):
+        for path in (os.path.join(self.path, name),
+                     os.path.join(self.path, entry_id + '.data'),
+                     os.path.join(self.path, entry_id + '.intent')):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _clean_done(self):
+        limit = time.time() - DONE_TTL
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if (name.endswith('.done') or name.endswith('.failed')) and \
+                    os.path.getmtime(path) < limit:
+                os.unlink(path)
+
+    def _collect(self):
+        """
+        Resolve the futures of the writes of this process that have been
+        committed, by this or by another process.
+        """
+        with self._lock:
+            futures = list(self._futures.items())
+        for entry_id, future in futures:
+            done = os.path.join(self.path, entry_id + '.done')
+            failed = os.path.join(self.path, entry_id + '.failed')
+            if os.path.exists(done):
+                with open(done) as f:
+                    versionid = f.read() or None
+                os.unlink(done)
+                exception = None
+            elif os.path.exists(failed):
+                with open(failed) as f:
+                    exception = SpoolError(f.read().decode('utf8'))
+                os.unlink(failed)
+            else:
+                continue
+            with self._lock:
+                if self._futures.pop(entry_id, None) is None:
+                    continue
+            if exception is None:
+                future.set_result(versionid)
+            else:
+                future.set_exception(exception)
+
+    def stats(self):
+        """
+        Return the number of spooled writes ('depth'), the age in seconds
+        of the oldest of them ('lag'), the number of writes committed by
+        this process ('committed'), the time the last of them waited in
+        the spool ('last_lag') and the number of writes given up, in the
+        dead letter directory ('dead').
+        """
+        entries = self._names()
+        lag = 0
+        if entries:
+            lag = max(time.time() - int(entries[0].split('-')[0]) / 1e6, 0)
+        dead = len([name for name in os.listdir(self.dead_path)
+                    if name.endswith('.json')])
+        return {'depth': len(entries), 'lag': lag,
+                'committed': self._committed, 'last_lag': self._last_lag,
+                'dead': dead}
+
+    def close(self):
+        """
+        Commit whatever is spooled and stop the background thread.
+        """
+        self._closed = True
+        self._wake.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
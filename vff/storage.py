@@ -27,12 +27,95 @@
 # either expressed or implied, of Terena.
 
 import os
+import copy
+import weakref
 
 from django.conf import settings
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
 from django.utils.encoding import force_unicode
 
+from vff.git_stream import content_size
+from vff.instrumentation import InstrumentedBackend, enabled, measure, timed
+
+try:
+    on_commit = transaction.on_commit
+except AttributeError:
+    # django < 1.9 has no on_commit hooks: keep them on the connection, and
+    # run them once it commits, as django-transaction-hooks does
+    def on_commit(func, using=None):
+        """
+        Call func once the current transaction on the database using
+        commits, or right away if there is none. func is forgotten if the
+        transaction, or the savepoint it was registered in, is rolled back.
+        """
+        connection = transaction.get_connection(using)
+        if not connection.in_atomic_block:
+            if not connection.get_autocommit():
+                raise transaction.TransactionManagementError(
+                    'on_commit() cannot be used in manual transaction '
+                    'management')
+            func()
+            return
+        if not hasattr(connection, 'vff_commit_hooks'):
+            _hook_connection(connection)
+        connection.vff_commit_hooks.append(
+            (set(connection.savepoint_ids), func))
+
+    def _hook_connection(connection):
+        """
+        Wrap the transaction methods of connection, to run or forget the
+        functions registered with on_commit.
+        """
+        connection.vff_commit_hooks = []
+        connection.vff_run_hooks_on_autocommit = False
+        commit = connection.commit
+        rollback = connection.rollback
+        savepoint_rollback = connection.savepoint_rollback
+        set_autocommit = connection.set_autocommit
+
+        def run_hooks():
+            connection.vff_run_hooks_on_autocommit = False
+            hooks = connection.vff_commit_hooks
+            connection.vff_commit_hooks = []
+            for sids, func in hooks:
+                func()
+
+        def hooked_commit():
+            commit()
+            # the outermost atomic block commits before turning autocommit
+            # back on, and the hooks may use the database
+            if connection.features.autocommits_when_autocommit_is_off:
+                # sqlite is back in autocommit once committed, the atomic
+                # block only sets the flag afterwards
+                connection.autocommit = True
+                run_hooks()
+            else:
+                connection.vff_run_hooks_on_autocommit = True
+
+        def hooked_rollback():
+            connection.vff_commit_hooks = []
+            connection.vff_run_hooks_on_autocommit = False
+            rollback()
+
+        def hooked_savepoint_rollback(sid):
+            savepoint_rollback(sid)
+            connection.vff_commit_hooks = [
+                (sids, func) for sids, func in connection.vff_commit_hooks
+                if sid not in sids]
+
+        def hooked_set_autocommit(autocommit):
+            set_autocommit(autocommit)
+            if autocommit and connection.vff_run_hooks_on_autocommit:
+                run_hooks()
+
+        connection.commit = hooked_commit
+        connection.rollback = hooked_rollback
+        connection.savepoint_rollback = hooked_savepoint_rollback
+        connection.set_autocommit = hooked_set_autocommit
+
 
 class VersionedStorage(FileSystemStorage):
     """
@@ -40,52 +123,118 @@ class VersionedStorage(FileSystemStorage):
     """
 
     def __init__(self, backend_class, fieldname):
-        self.backend = backend_class(fieldname)
+        self.backend_class = backend_class
+        self._backend = None
         location = getattr(settings, 'VFF_REPO_ROOT',
                     os.path.join(settings.MEDIA_ROOT, 'vf_repo'))
         self.location = os.path.abspath(location)
         self.fieldname = fieldname
+        # writes waiting for their instance to be saved or deleted, keyed
+        # by id(instance), with a weak reference to the instance, so that
+        # they go away with instances that never get saved
+        self._pending = {}
+
+    @property
+    def backend(self):
+        """
+        The backend of the field, only built on first use, so that defining
+        the models does no repository work.
+        """
+        if self._backend is None:
+            backend = self.backend_class(self.fieldname)
+            if enabled():
+                backend = InstrumentedBackend(backend)
+            self._backend = backend
+        return self._backend
+
+    def connect(self):
+        """
+        Connect the receivers that carry out the pending writes. They are
+        connected once per storage, for all senders, since instances of
+        subclasses and proxies of the model are sent as themselves.
+        """
+        post_save.connect(self._saved, weak=False,
+                          dispatch_uid='vff-save-%d' % id(self))
+        post_delete.connect(self._deleted, weak=False,
+                            dispatch_uid='vff-delete-%d' % id(self))
+
+    def size(self, name):
+        get_size = getattr(self.backend, 'get_size', None)
+        if get_size is not None:
+            return get_size(name)
+        return super(VersionedStorage, self).size(name)
+
+    def _register(self, instance, action, args):
+        key = id(instance)
+
+        def forget(ref):
+            if self._pending.get(key, (None,))[0] is ref:
+                del self._pending[key]
+        self._pending[key] = (weakref.ref(instance, forget), action, args)
+
+    def _pop(self, instance, action):
+        """
+        Return the args of the write of the given action pending for
+        instance, if any, and forget it.
+        """
+        if not self._pending:
+            return None
+        entry = self._pending.get(id(instance))
+        if entry is None or entry[0]() is not instance or entry[1] != action:
+            return None
+        del self._pending[id(instance)]
+        return entry[2]
+
+    def save(self, uid, content, username, commit_msg, save, instance):
+        """
+        Add content as a new revision of the document of instance once the
+        instance is saved, after the transaction it is saved in commits.
+        """
+        self._register(instance, 'save', (content, username, commit_msg,
+                                          save))
+        return force_unicode(uid.replace('\\', '/'))
 
-    def save(self, uid, content, username, commit_msg, save):
-        def savefile(sender, instance=None, **kwargs):
-            # check that the instance is the right one
-            try:
-                saved_uid = getattr(instance, self.fieldname).name
-            except AttributeError:
-                # an instance of another class
-                return
-            if saved_uid != uid:
-                return
+    def _saved(self, sender, instance=None, created=False, using=None,
+               **kwargs):
+        args = self._pop(instance, 'save')
+        if args is None:
+            return
+        content, username, commit_msg, save = args
+        with measure('storage.save', self) as m:
+            m.nbytes = content_size(content)
             # create the actual filename from the versioned file
             name = self.backend.get_filename(instance)
             content.name = name
-            # new revision
-            self.backend.add_revision(content, instance, commit_msg, username)
-
-            if save or kwargs['created']:
+            if save or created:
+                fieldfile = getattr(instance, self.fieldname)
                 setattr(instance, self.fieldname, name)
-                instance.save()
+                instance.__class__._default_manager.using(using).filter(
+                    pk=instance.pk).update(**{fieldfile.field.attname: name})
 
-            # remove signal
-            post_save.disconnect(dispatch_uid=uid)
+            def add_revision():
+                self.backend.add_revision(content, instance, commit_msg,
+                                          username,
+                                          callback=self._sync_callback(
+                                              instance, using))
+            on_commit(add_revision, using=using)
 
-        post_save.connect(savefile, weak=False, dispatch_uid=uid)
+    def delete(self, uid, username, commit_msg, save, instance):
+        """
+        Remove the document of instance once the instance is deleted, after
+        the transaction it is deleted in commits.
+        """
+        self._register(instance, 'delete', (username, commit_msg, save))
         return force_unicode(uid.replace('\\', '/'))
 
-    def delete(self, uid, username, commit_msg, save):
-        def deletefile(sender, instance=None, **kwargs):
-            # check that the instance is the right one
+    def _deleted(self, sender, instance=None, using=None, **kwargs):
+        args = self._pop(instance, 'delete')
+        if args is None:
+            return
+        username, commit_msg, save = args
+        with measure('storage.delete', self):
             fieldfile = getattr(instance, self.fieldname)
-            try:
-                saved_uid = fieldfile.name
-            except AttributeError:
-                # an instance of another class
-                return
-            if saved_uid != uid:
-                return
             fieldfile.name = None
             setattr(instance, fieldfile.field.name, fieldfile.name)
-            self.backend.del_document(instance, commit_msg, username)
 
             # Delete the filesize cache
             if hasattr(fieldfile, '_size'):
@@ -95,8 +244,143 @@ class VersionedStorage(FileSystemStorage):
             if save:
                 instance.save()
 
-            # remove signal
-            post_delete.disconnect(dispatch_uid=uid)
+            # django clears the pk of the instance once it is deleted, and the
+            # backend needs it to find the document
+            deleted = copy.copy(instance)
 
-        post_delete.connect(deletefile, weak=False, dispatch_uid=uid)
-        return force_unicode(uid.replace('\\', '/'))
+            def del_document():
+                self.backend.del_document(deleted, commit_msg, username)
+            on_commit(del_document, using=using)
+
+    @timed('storage.bulk_save')
+    def bulk_save(self, revisions, username, commit_msg, save=True):
+        """
+        Add a new revision to the document of each of many saved instances,
+        committing them all at once, and return the versionid of the
+        commit. revisions is an iterable of (instance, content) tuples. If
+        save is true, the name of each document is stored in the database.
+        """
+        revisions = list(revisions)
+        for instance, content in revisions:
+            if instance.pk is None:
+                raise ValueError('Instances must be saved before their'
+                                 ' documents can be bulk saved.')
+        versionid = self.backend.bulk_add_revisions(revisions, commit_msg,
+                                                    username)
+        if self._has_latest_columns(revisions and revisions[0][0]):
+            self.bulk_sync_latest([instance for instance, content
+                                   in revisions])
+        with transaction.atomic():
+            for instance, content in revisions:
+                name = self.backend.get_filename(instance)
+                fieldfile = getattr(instance, self.fieldname)
+                fieldfile.name = name
+                fieldfile._committed = True
+                fieldfile._clear_prefetched()
+                if save:
+                    instance.__class__._default_manager.filter(
+                        pk=instance.pk).update(**{fieldfile.field.attname: name})
+        return versionid
+
+    @timed('storage.bulk_delete')
+    def bulk_delete(self, instances, username, commit_msg):
+        """
+        Remove the documents of many instances, committing it all at once,
+        and return the versionid of the commit. The instances themselves
+        are left alone.
+        """
+        instances = list(instances)
+        versionid = self.backend.bulk_del_documents(instances, commit_msg,
+                                                    username)
+        if self._has_latest_columns(instances and instances[0]):
+            self.bulk_sync_latest(instances)
+        for instance in instances:
+            fieldfile = getattr(instance, self.fieldname)
+            if hasattr(fieldfile, '_file'):
+                fieldfile.close()
+                del fieldfile.file
+            if hasattr(fieldfile, '_size'):
+                del fieldfile._size
+            fieldfile._committed = False
+            fieldfile._clear_prefetched()
+        return versionid
+
+    def asave(self, instance, content, username, commit_msg):
+        """
+        Add content as a new revision of the document of instance, which
+        must be saved, committing it right away (as bulk_save) in the
+        writer thread of its executor. Return a future for the versionid.
+        """
+        if instance.pk is None:
+            raise ValueError('Instances must be saved before their'
+                             ' documents can be saved asynchronously.')
+        return self.backend.get_executor(instance).write(
+            self.bulk_save, [(instance, content)], username, commit_msg)
+
+    def adelete(self, instance, username, commit_msg):
+        """
+        Remove the document of instance, leaving the instance alone (as
+        bulk_delete), in the writer thread of its executor. Return a
+        future for the versionid.
+        """
+        return self.backend.get_executor(instance).write(
+            self.bulk_delete, [instance], username, commit_msg)
+
+    def _has_latest_columns(self, instance):
+        if not instance:
+            return False
+        field = getattr(instance, self.fieldname).field
+        return field.latest_columns
+
+    def _sync_callback(self, instance, using):
+        """
+        Return a callback for the backend write of the document of
+        instance, that syncs its latest columns, if it has them.
+        """
+        if not self._has_latest_columns(instance):
+            return None
+
+        def sync(versionid):
+            self.sync_latest(instance, using=using)
+        return sync
+
+    @timed('storage.sync_latest')
+    def sync_latest(self, instance, using=None):
+        """
+        Update the latest columns of instance (see the latest_columns
+        argument of VersionedFileField) from the backend, in the database
+        and in instance itself. A removed document keeps its latest
+        revision (the removal) and count, and has no size.
+        """
+        self.bulk_sync_latest([instance], using=using)
+
+    @timed('storage.bulk_sync_latest')
+    def bulk_sync_latest(self, instances, using=None):
+        """
+        Update the latest columns of many instances, as sync_latest, asking
+        the backend for the latest revisions of all their documents at
+        once, and writing them in a single transaction.
+        """
+        instances = list(instances)
+        metadata = self.backend.latest_metadata(instances)
+        with transaction.atomic(using=using):
+            for instance in instances:
+                latest, size, count = metadata[instance.pk]
+                date = latest and latest['date']
+                if (date is not None and settings.USE_TZ and
+                        timezone.is_naive(date)):
+                    date = timezone.make_aware(
+                        date, timezone.get_current_timezone())
+                values = {
+                    '_sha': latest and latest['versionid'],
+                    '_author': latest and latest['author'][:255],
+                    '_date': date,
+                    '_size': size,
+                    '_revcount': count,
+                }
+                values = dict((self.fieldname + suffix, value)
+                              for suffix, value in values.items())
+                instance.__class__._default_manager.using(using).filter(
+                    pk=instance.pk).update(**values)
+                for name, value in values.items():
+                    setattr(instance, name, value)
\ No newline at end of file